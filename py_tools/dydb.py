@@ -1,18 +1,34 @@
+import decimal
 import functools
 import operator
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import ContextVar
 from copy import deepcopy
+from datetime import datetime
 from py_tools.date import datetime_utc
 from typing import Any, Dict, List, Optional, Union
 from py_tools.dydb_attrs import UserTimezoneDateTimeAttribute
-from pynamodb.exceptions import DoesNotExist
+from py_tools.dydb_cache import CachedResults
+from pynamodb.exceptions import DoesNotExist, TransactWriteError
 from pynamodb.models import Model
 from pynamodb.transactions import TransactWrite as _TransactWrite
 from py_tools import format
 from py_tools.pylog import get_logger
+from py_tools.retry import backoff_sleep
 
 logger = get_logger("py-tools.dydb")
 
+BATCH_GET_LIMIT = 100  # keys per BatchGetItem request
+TRANSACT_WRITE_LIMIT = 100  # operations per TransactWriteItems request
+TRANSACT_WRITE_MAX_BYTES = 4 * 1024 * 1024
+TRANSACT_WRITE_RETRIES = 5
+
+# conditions added ahead of the next save/update/delete/query, per class name;
+# a contextvar keeps threads and asyncio tasks from consuming each other's
+_db_conditions = ContextVar("db_conditions", default={})
+
 
 class ModelEncoder(format.ModelEncoder):
     def default(self, obj):
@@ -21,8 +37,51 @@ class ModelEncoder(format.ModelEncoder):
         return super(ModelEncoder, self).default(obj)
 
 
+_SCALARS = (str, int, float, bool, type(None))
+_encoder = ModelEncoder()
+
+
+def _json_key(key):
+    if isinstance(key, str):
+        return key
+    if isinstance(key, bytes):
+        return key.decode("utf-8")
+    if key is True or key is False:
+        return "true" if key else "false"
+    if key is None:
+        return "null"
+    return str(key)
+
+
+def to_plain(value):
+    """Same output as a ModelEncoder dumps/loads round trip, without the JSON."""
+    if type(value) in _SCALARS:
+        return value
+    if isinstance(value, dict):
+        return {_json_key(k): to_plain(v) for k, v in value.items()}
+    if isinstance(value, bytes):
+        # simplejson encodes bytes as their utf-8 decoded text
+        return value.decode("utf-8")
+    if hasattr(value, "attribute_values"):
+        return to_plain(value.attribute_values)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        # dumps writes decimals as numbers, which loads reads back as int or float
+        text = str(value)
+        return int(text) if text.lstrip("-").isdigit() else float(text)
+    if hasattr(value, "_asdict"):
+        return to_plain(value._asdict())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [to_plain(v) for v in value]
+    if isinstance(value, _SCALARS):
+        return to_plain(format.loads(format.dumps(value)))
+    return to_plain(_encoder.default(value))
+
+
 class DbModel(Model):
-    _db_conditions = {}
+    read_cache = None  # opt in with a py_tools.dydb_cache.ModelCache
+    write_buffer = None  # opt in with a py_tools.dydb_buffer.WriteBuffer
     created_on = UserTimezoneDateTimeAttribute()
     updated_on = UserTimezoneDateTimeAttribute()
 
@@ -31,14 +90,41 @@ class DbModel(Model):
         self._hash_key = getattr(self.__class__, self._hash_keyname)
 
     def dict(self):
-        return format.loads(format.dumps(self, cls=ModelEncoder))
+        return to_plain(self.attribute_values)
+
+    @staticmethod
+    def dicts(items):
+        """Lazily convert an iterable of models to dicts."""
+        for item in items:
+            yield item.dict()
 
     @staticmethod
     def get_first(items):
-        items = [i.dict() for i in items]
-        if not items:
-            raise DoesNotExist
-        return items[0]
+        for item in items:
+            return item.dict()
+        raise DoesNotExist
+
+    def _cache_key_values(self):
+        range_key = getattr(self, self._range_keyname) if self._range_keyname else None
+        return getattr(self, self._hash_keyname), range_key
+
+    def invalidate_cache(self):
+        cache = self.__class__.read_cache
+        if cache is not None:
+            cache.invalidate(self._cache_key_values()[0])
+
+    def _write_cache(self):
+        cache = self.__class__.read_cache
+        if cache is None:
+            return
+        hash_key, range_key = self._cache_key_values()
+        cache.invalidate(hash_key)
+        cache.set(("get", hash_key, range_key, ()), self.serialize(null_check=False))
+
+    def _flush_pending(self):
+        buffer = self.__class__.write_buffer
+        if buffer is not None:
+            buffer.flush_key(self.__class__, *self._cache_key_values())
 
     @property
     def key(self):
@@ -50,23 +136,30 @@ class DbModel(Model):
     @classmethod
     def add_db_conditions(cls, condition: Optional[Any]):
         logger.debug("Adding condition %s from class %s" % (condition, cls.__name__))
-        if cls.__name__ not in cls._db_conditions:
-            cls._db_conditions[cls.__name__] = []
-        cls._db_conditions[cls.__name__].append(condition)
+        # never mutate in place, other contexts may share the same dict
+        pending = dict(_db_conditions.get())
+        pending[cls.__name__] = pending.get(cls.__name__, ()) + (condition,)
+        _db_conditions.set(pending)
 
     @classmethod
-    def _output_db_condition(cls):
+    def _output_db_condition(cls, *conditions):
         logger.debug("Getting conditions for class %s" % cls.__name__)
-        items = deepcopy(cls._db_conditions.pop(cls.__name__, []))
+        pending = _db_conditions.get()
+        items = pending.get(cls.__name__, ())
+        if items:
+            pending = dict(pending)
+            del pending[cls.__name__]
+            _db_conditions.set(pending)
+        items = [c for c in items + conditions if c is not None]
         if not items:
             logger.debug("Conditions is empty")
             return None
         cond_len = len(items)
         logger.debug("Conditions contains %s items" % cond_len)
         if cond_len == 1:
-            output = next(iter(items))
+            output = items[0]
         else:
-            output = functools.reduce(operator.iand, items)
+            output = functools.reduce(operator.and_, items)
 
         return output
 
@@ -79,32 +172,47 @@ class DbModel(Model):
         attributes_to_get=None,
     ):
         hash_key = hash_key or os.environ.get("HASH_KEY", None)
+        if cls.write_buffer is not None:
+            cls.write_buffer.flush_key(cls, hash_key, range_key)
+        cache = cls.read_cache
+        key = ("get", hash_key, range_key, tuple(attributes_to_get or ()))
+        if cache is not None and not consistent_read:
+            found, data = cache.get(key)
+            if found:
+                return cls.from_raw_data(data)
         item = super(DbModel, cls).get(
             hash_key, range_key, consistent_read, attributes_to_get
         )
+        if cache is not None:
+            cache.set(key, item.serialize(null_check=False))
         return item
 
     def save(self, condition=None, overwrite=False):
-        if not overwrite:
-            self.add_db_conditions(self._hash_key.does_not_exist())
-        if condition is not None:
-            self.add_db_conditions(condition)
-        return super(DbModel, self).save(self.__class__._output_db_condition())
+        self._flush_pending()
+        condition = self.__class__._output_db_condition(
+            None if overwrite else self._hash_key.does_not_exist(), condition
+        )
+        output = super(DbModel, self).save(condition)
+        self._write_cache()
+        return output
 
     def update(self, actions, condition=None, overwrite=False):
-        if not overwrite:
-            self.add_db_conditions(self._hash_key.exists())
-        if condition is not None:
-            self.add_db_conditions(condition)
-        return super(DbModel, self).update(
-            actions, self.__class__._output_db_condition()
+        self._flush_pending()
+        condition = self.__class__._output_db_condition(
+            None if overwrite else self._hash_key.exists(), condition
         )
+        output = super(DbModel, self).update(actions, condition)
+        self._write_cache()
+        return output
 
     def delete(self, condition=None):
-        self.add_db_conditions(self._hash_key.exists())
-        if condition is not None:
-            self.add_db_conditions(condition)
-        return super(DbModel, self).delete(self.__class__._output_db_condition())
+        self._flush_pending()
+        condition = self.__class__._output_db_condition(
+            self._hash_key.exists(), condition
+        )
+        output = super(DbModel, self).delete(condition)
+        self.invalidate_cache()
+        return output
 
     @classmethod
     def save_attributes(cls, item, **kwargs):
@@ -200,6 +308,51 @@ class DbModel(Model):
         overwrite=False,
     ):
         hash_key = hash_key or os.environ.get("HASH_KEY", None)
+        buffer = cls.write_buffer
+        if buffer is not None:
+            # actions and pending conditions cannot be merged, write those now
+            if (
+                actions is None
+                and cls.__name__ not in _db_conditions.get()
+                and buffer.add(
+                    cls,
+                    hash_key,
+                    range_key,
+                    overwrite,
+                    updates,
+                    deletes,
+                    adds,
+                    appends,
+                    prepends,
+                )
+            ):
+                return cls(hash_key, range_key)
+            buffer.flush_key(cls, hash_key, range_key)
+        return cls._update_item(
+            hash_key,
+            range_key,
+            updates,
+            deletes,
+            adds,
+            appends,
+            prepends,
+            actions,
+            overwrite,
+        )
+
+    @classmethod
+    def _update_item(
+        cls,
+        hash_key,
+        range_key=None,
+        updates=None,
+        deletes=None,
+        adds=None,
+        appends=None,
+        prepends=None,
+        actions=None,
+        overwrite=False,
+    ):
         cls_obj = cls(hash_key, range_key)
         cls_obj.update(
             cls.update_attributes(updates, deletes, adds, appends, prepends, actions),
@@ -230,10 +383,34 @@ class DbModel(Model):
         **filters,
     ):
         hash_key = hash_key or os.environ.get("HASH_KEY", None)
+        if cls.write_buffer is not None:
+            # an index query may return any item of the table
+            cls.write_buffer.flush_model(
+                cls, hash_key if index_name is None else None
+            )
+        filter_condition = cls._output_db_condition()
+        cache = None if consistent_read else cls.read_cache
+        if cache is not None:
+            key = (
+                "query",
+                hash_key,
+                index_name,
+                str(range_key_condition),
+                str(filter_condition),
+                scan_index_forward,
+                limit,
+                str(last_evaluated_key),
+                tuple(attributes_to_get or ()),
+            )
+            found, data = cache.get(key)
+            if found:
+                return CachedResults(
+                    [cls.from_raw_data(item) for item in data[0]], data[1]
+                )
         items = super(DbModel, cls).query(
             hash_key=hash_key,
             range_key_condition=range_key_condition,
-            filter_condition=cls._output_db_condition(),
+            filter_condition=filter_condition,
             consistent_read=consistent_read,
             index_name=index_name,
             scan_index_forward=scan_index_forward,
@@ -243,38 +420,167 @@ class DbModel(Model):
             page_size=page_size,
             rate_limit=rate_limit,
         )
+        if cache is None:
+            return items
+        results = list(items)
+        cache.set(
+            key,
+            (
+                [item.serialize(null_check=False) for item in results],
+                items.last_evaluated_key,
+            ),
+        )
+        return CachedResults(results, items.last_evaluated_key)
+
+    @classmethod
+    def _batch_key(cls, key):
+        """Serialized key for a hash key or a (hash key, range key) pair."""
+        hash_attr = cls._hash_key_attribute()
+        range_attr = cls._range_key_attribute()
+        if range_attr:
+            hash_key, range_key = key
+        else:
+            hash_key, range_key = key, None
+        hash_key = hash_key or os.environ.get("HASH_KEY", None)
+        hash_ser, range_ser = cls._serialize_keys(hash_key, range_key)
+        output = {hash_attr.attr_name: hash_ser}
+        if range_attr:
+            output[range_attr.attr_name] = range_ser
+        return output
+
+    @classmethod
+    def _batch_key_id(cls, data):
+        """Hashable identity of a request key or a returned item's key."""
+        output = []
+        for attr in (cls._hash_key_attribute(), cls._range_key_attribute()):
+            if attr:
+                value = data[attr.attr_name]
+                if isinstance(value, dict):
+                    value = value[attr.attr_type]
+                output.append(value)
+        return tuple(output)
+
+    @classmethod
+    def _batch_get_chunk(cls, keys, consistent_read, attributes_to_get):
+        items = []
+        attempt = 0
+        while keys:
+            page, keys = cls._batch_get_page(keys, consistent_read, attributes_to_get)
+            items.extend(page or [])
+            if keys:
+                logger.debug("Retrying %s unprocessed keys" % len(keys))
+                backoff_sleep(attempt)
+                attempt += 1
         return items
 
+    @classmethod
+    def _batch_get_raw(cls, keys, consistent_read, attributes_to_get, max_workers):
+        chunks = [
+            keys[i : i + BATCH_GET_LIMIT] for i in range(0, len(keys), BATCH_GET_LIMIT)
+        ]
+        if len(chunks) <= 1 or max_workers <= 1:
+            for chunk in chunks:
+                yield from cls._batch_get_chunk(chunk, consistent_read, attributes_to_get)
+            return
+        # create the shared botocore client before the threads race for it
+        cls._get_connection().connection.client
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            futures = [
+                executor.submit(
+                    cls._batch_get_chunk, chunk, consistent_read, attributes_to_get
+                )
+                for chunk in chunks
+            ]
+            for future in as_completed(futures):
+                yield from future.result()
+
+    @classmethod
+    def batch_get(
+        cls,
+        items,
+        consistent_read=None,
+        attributes_to_get=None,
+        ordered=False,
+        max_workers=4,
+    ):
+        """BatchGetItem in chunks of 100 keys, fetched concurrently.
+
+        items are hash keys, or (hash key, range key) pairs for models with
+        a range key; a missing hash key falls back to HASH_KEY. Models are
+        streamed as chunks complete, or with ordered=True returned as a list
+        aligned with items, holding None for keys that were not found.
+        """
+        requested = []
+        keys = {}
+        items = list(items)
+        if cls.write_buffer is not None:
+            for item in items:
+                hash_key, range_key = item if cls._range_keyname else (item, None)
+                cls.write_buffer.flush_key(
+                    cls, hash_key or os.environ.get("HASH_KEY", None), range_key
+                )
+        for item in items:
+            key = cls._batch_key(item)
+            key_id = cls._batch_key_id(key)
+            requested.append(key_id)
+            keys.setdefault(key_id, key)
+        if ordered and attributes_to_get:
+            attributes_to_get = list(attributes_to_get) + [
+                attr.attr_name
+                for attr in (cls._hash_key_attribute(), cls._range_key_attribute())
+                if attr and attr.attr_name not in attributes_to_get
+            ]
+        results = cls._batch_get_raw(
+            list(keys.values()), consistent_read, attributes_to_get, max_workers
+        )
+        if not ordered:
+            return (cls.from_raw_data(data) for data in results)
+        found = {cls._batch_key_id(data): data for data in results}
+        return [
+            cls.from_raw_data(found[key_id]) if key_id in found else None
+            for key_id in requested
+        ]
+
 
 class TransactWrite(_TransactWrite):
+    def __init__(self, *args, **kwargs):
+        super(TransactWrite, self).__init__(*args, **kwargs)
+        self._cached_models = []
+
+    def _commit(self):
+        try:
+            return super(TransactWrite, self)._commit()
+        finally:
+            # also on failure, a cancelled transaction may be retried elsewhere
+            for model in self._cached_models:
+                model.invalidate_cache()
+
     def save(self, model, condition=None, return_values=None, **kwargs):
         key_name = model._hash_keyname
         overwrite = kwargs.get("overwrite", False)
         hash_key = getattr(model.__class__, key_name)
-        if not overwrite:
-            model.add_db_conditions(hash_key.does_not_exist())
-        if condition is not None:
-            model.add_db_conditions(condition)
-        condition = model._output_db_condition()
+        condition = model._output_db_condition(
+            None if overwrite else hash_key.does_not_exist(), condition
+        )
         # set hash key if missing
         if not getattr(model, key_name):
             if "HASH_KEY" in os.environ:
                 setattr(model, key_name, os.environ["HASH_KEY"])
+        self._cached_models.append(model)
         return super(TransactWrite, self).save(model, condition, return_values)
 
     def update(self, model, actions, condition=None, return_values=None, **kwargs):
         key_name = model._hash_keyname
         overwrite = kwargs.get("overwrite", False)
         hash_key = getattr(model.__class__, key_name)
-        if not overwrite:
-            model.add_db_conditions(hash_key.exists())
-        if condition is not None:
-            model.add_db_conditions(condition)
-        condition = model._output_db_condition()
+        condition = model._output_db_condition(
+            None if overwrite else hash_key.exists(), condition
+        )
         # set hash key if missing
         if not getattr(model, key_name):
             if "HASH_KEY" in os.environ:
                 setattr(model, key_name, os.environ["HASH_KEY"])
+        self._cached_models.append(model)
         return super(TransactWrite, self).update(
             model, actions, condition, return_values
         )
@@ -282,14 +588,12 @@ class TransactWrite(_TransactWrite):
     def delete(self, model, condition=None):
         key_name = model._hash_keyname
         hash_key = getattr(model.__class__, key_name)
-        model.add_db_conditions(hash_key.exists())
-        if condition is not None:
-            model.add_db_conditions(condition)
-        condition = model._output_db_condition()
+        condition = model._output_db_condition(hash_key.exists(), condition)
         # set hash key if missing
         if not getattr(model, key_name):
             if "HASH_KEY" in os.environ:
                 setattr(model, key_name, os.environ["HASH_KEY"])
+        self._cached_models.append(model)
         super(TransactWrite, self).delete(model, condition)
 
     def condition_check(self, model_cls, hash_key=None, range_key=None, condition=None):
@@ -297,9 +601,7 @@ class TransactWrite(_TransactWrite):
         if hash_key is None:
             hash_key = os.environ["HASH_KEY"]
 
-        if condition is not None:
-            model_cls.add_db_conditions(condition)
-        condition = model_cls._output_db_condition()
+        condition = model_cls._output_db_condition(condition)
 
         if condition is None:
             return
@@ -307,3 +609,219 @@ class TransactWrite(_TransactWrite):
         return super(TransactWrite, self).condition_check(
             model_cls, hash_key, range_key, condition
         )
+
+
+def _value_size(value):
+    """Byte size of a serialized attribute value, as DynamoDB counts it."""
+    (type_, data), = value.items()
+    if type_ == "S":
+        return len(data.encode("utf-8"))
+    if type_ == "N":
+        return len(data)
+    if type_ == "B":
+        return len(data)
+    if type_ in ("SS", "NS", "BS"):
+        return sum(_value_size({type_[0]: v}) for v in data)
+    if type_ == "M":
+        return 3 + _map_size(data)
+    if type_ == "L":
+        return 3 + sum(1 + _value_size(v) for v in data)
+    return 1  # BOOL and NULL
+
+
+def _map_size(values):
+    return sum(
+        len(name.encode("utf-8")) + _value_size(value) for name, value in values.items()
+    )
+
+
+def _operation_size(operation):
+    """Byte size of a transaction operation: its item or key, expression
+    values and expression strings."""
+    size = 0
+    for name, value in operation.items():
+        if name in ("Item", "Key", "ExpressionAttributeValues"):
+            size += _map_size(value)
+        elif name == "ExpressionAttributeNames":
+            size += sum(len(v.encode("utf-8")) for v in value.values())
+        elif isinstance(value, str):
+            size += len(value.encode("utf-8"))
+    return size
+
+
+class BulkTransactWrite:
+    """Transactional writes beyond the 100 operation / 4MB limits of one
+    TransactWriteItems call.
+
+    Operations sharing a group are always committed in the same transaction;
+    operations without a group are atomic on their own. Groups are packed
+    into as few transactions as fit, which are committed concurrently, and
+    TransactionConflict cancellations are retried with backoff.
+
+        with BulkTransactWrite() as writer:
+            writer.save(order, group=order.order_id)
+            writer.update(line, actions, group=order.order_id)
+    """
+
+    def __init__(
+        self,
+        connection=None,
+        max_workers=4,
+        retries=TRANSACT_WRITE_RETRIES,
+        **kwargs,
+    ):
+        self._connection = connection
+        self._kwargs = kwargs
+        self.max_workers = max_workers
+        self.retries = retries
+        self._groups = {}
+        self._sizes = {}
+        self._items = set()
+        self.responses = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+
+    def _add(self, model_cls, group, add):
+        if self._connection is None:
+            self._connection = model_cls._get_connection().connection
+        # a one operation transaction builds and holds the operation
+        probe = TransactWrite(connection=self._connection)
+        add(probe)
+        operations = (
+            probe._put_items
+            + probe._update_items
+            + probe._delete_items
+            + probe._condition_check_items
+        )
+        if not operations:
+            return
+        operation = operations[0]
+        item = (
+            operation["TableName"],
+            model_cls._batch_key_id(operation.get("Key") or operation["Item"]),
+        )
+        if item in self._items:
+            raise ValueError("%s %s is already part of this write" % item)
+        if group is None:
+            group = item
+        size = _operation_size(operation)
+        operations = self._groups.get(group, [])
+        if len(operations) + 1 > TRANSACT_WRITE_LIMIT:
+            raise ValueError(
+                "group %r exceeds %s operations" % (group, TRANSACT_WRITE_LIMIT)
+            )
+        if self._sizes.get(group, 0) + size > TRANSACT_WRITE_MAX_BYTES:
+            raise ValueError(
+                "group %r exceeds %s bytes" % (group, TRANSACT_WRITE_MAX_BYTES)
+            )
+        self._items.add(item)
+        self._groups.setdefault(group, []).append(probe)
+        self._sizes[group] = self._sizes.get(group, 0) + size
+
+    def save(self, model, condition=None, group=None, **kwargs):
+        self._add(
+            model.__class__,
+            group,
+            lambda transaction: transaction.save(model, condition, **kwargs),
+        )
+
+    def update(self, model, actions, condition=None, group=None, **kwargs):
+        self._add(
+            model.__class__,
+            group,
+            lambda transaction: transaction.update(model, actions, condition, **kwargs),
+        )
+
+    def delete(self, model, condition=None, group=None):
+        self._add(
+            model.__class__,
+            group,
+            lambda transaction: transaction.delete(model, condition),
+        )
+
+    def condition_check(
+        self, model_cls, hash_key=None, range_key=None, condition=None, group=None
+    ):
+        self._add(
+            model_cls,
+            group,
+            lambda transaction: transaction.condition_check(
+                model_cls, hash_key, range_key, condition
+            ),
+        )
+
+    def _transactions(self):
+        """First-fit decreasing packing of whole groups into transactions."""
+        groups = sorted(
+            self._groups,
+            key=lambda group: (self._sizes[group], len(self._groups[group])),
+            reverse=True,
+        )
+        transactions = []
+        for group in groups:
+            probes = self._groups[group]
+            size = self._sizes[group]
+            for transaction in transactions:
+                if (
+                    len(transaction[0]) + len(probes) <= TRANSACT_WRITE_LIMIT
+                    and transaction[1] + size <= TRANSACT_WRITE_MAX_BYTES
+                ):
+                    transaction[0].extend(probes)
+                    transaction[1] += size
+                    break
+            else:
+                transactions.append([list(probes), size])
+        return [probes for probes, _ in transactions]
+
+    def _commit_transaction(self, probes):
+        # the same token on every attempt keeps a retried commit idempotent
+        transaction = TransactWrite(
+            connection=self._connection,
+            client_request_token=str(uuid.uuid4()),
+            **self._kwargs,
+        )
+        for probe in probes:
+            transaction._put_items.extend(probe._put_items)
+            transaction._update_items.extend(probe._update_items)
+            transaction._delete_items.extend(probe._delete_items)
+            transaction._condition_check_items.extend(probe._condition_check_items)
+            transaction._models_for_version_attribute_update.extend(
+                probe._models_for_version_attribute_update
+            )
+            transaction._cached_models.extend(probe._cached_models)
+        attempt = 0
+        while True:
+            try:
+                return transaction._commit()
+            except TransactWriteError as e:
+                reasons = [r.code for r in e.cancellation_reasons if r is not None]
+                if attempt >= self.retries or "TransactionConflict" not in reasons:
+                    raise
+                logger.debug("Retrying conflicted transaction of %s" % len(probes))
+                backoff_sleep(attempt)
+                attempt += 1
+
+    def commit(self):
+        """Commit every transaction and return their responses. If any
+        fails the others still run, and the first error is raised."""
+        transactions = self._transactions()
+        self._groups, self._sizes, self._items = {}, {}, set()
+        if len(transactions) <= 1 or self.max_workers <= 1:
+            self.responses = [self._commit_transaction(t) for t in transactions]
+            return self.responses
+        with ThreadPoolExecutor(
+            max_workers=min(self.max_workers, len(transactions))
+        ) as executor:
+            futures = [executor.submit(self._commit_transaction, t) for t in transactions]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        for error in errors[1:]:
+            logger.error("Transaction failed: %s" % error)
+        if errors:
+            raise errors[0]
+        self.responses = [f.result() for f in futures]
+        return self.responses
@@ -1,8 +1,9 @@
-import random
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import boto3
-from py_tools.dydb_utils import deserialize_output, serialize_input
+from botocore.exceptions import ClientError
+from py_tools.dydb_codec import deserialize_items, serialize_item
 from py_tools.pylog import get_logger
+from py_tools.retry import backoff_sleep
 from py_tools.format import dumps
 
 
@@ -10,6 +11,45 @@ dynamodb_client = boto3.client("dynamodb")
 dynamodb_resource = boto3.resource("dynamodb")
 logger = get_logger("py-tools.dydb_batch")
 
+BATCH_READ_LIMIT = 100  # keys per batch_get_item request, across tables
+BATCH_WRITE_LIMIT = 25  # requests per batch_write_item call
+BATCH_WRITE_RETRIES = 8
+
+
+class UnprocessedItemsError(Exception):
+    """Raised by batch_write when items were still unprocessed after every
+    retry; reports holds the per-table results including them."""
+
+    def __init__(self, reports):
+        self.reports = reports
+        counts = {
+            table: len(report["unprocessed"])
+            for table, report in reports.items()
+            if report["unprocessed"]
+        }
+        super(UnprocessedItemsError, self).__init__(
+            "Unprocessed items after retries: %s" % counts
+        )
+
+
+_key_names = {}
+
+
+def describe_key_names(table_name):
+    """Key attribute names of a table from DescribeTable, or None when the
+    table cannot be described (e.g. the role may only write to it)."""
+    if table_name not in _key_names:
+        try:
+            table = dynamodb_resource.Table(table_name)
+            _key_names[table_name] = [k["AttributeName"] for k in table.key_schema]
+        except ClientError as e:
+            logger.warning(
+                "Cannot describe table %s, writing without deduplication: %s"
+                % (table_name, e)
+            )
+            _key_names[table_name] = None
+    return _key_names[table_name]
+
 
 def projection_string(func):
     def wrapper(*args, **kwargs):
@@ -34,8 +74,10 @@ def projection_string(func):
 
 
 class DynamoDbBatch:
-    def __init__(self, dry_run=False):
+    def __init__(self, dry_run=False, key_names=None):
         self.dry_run = dry_run
+        # {table: [key attribute names]}, used to deduplicate writes
+        self.key_names = dict(key_names or {})
         self.client = dynamodb_client
         self.resource_client = dynamodb_resource
         self.request_items = {}
@@ -51,63 +93,164 @@ class DynamoDbBatch:
         if key_frozenset not in self.get_items_keys[table]:
             # logger.debug("Queuing get item %s to table %s" % (dumps(key), table))
             self.get_items_keys[table].add(key_frozenset)
-            self.get_serialized_items[table]["Keys"].append(serialize_input(key))
+            self.get_serialized_items[table]["Keys"].append(serialize_item(key))
             self.get_serialized_items[table].update(kwargs)
 
-    def post_item(self, table, item):
+    def post_item(self, table, item, key_names=None):
+        if key_names:
+            self.key_names[table] = list(key_names)
         if table not in self.request_items:
             self.request_items[table] = []
         logger.debug("Queuing put item %s to table %s" % (dumps(item), table))
         self.request_items[table].append({"put_item": {"Item": item}})
 
-    def delete_item(self, table, key):
+    def delete_item(self, table, key, key_names=None):
+        if key_names:
+            self.key_names[table] = list(key_names)
         if table not in self.request_items:
             self.request_items[table] = []
         logger.debug("Queuing delelte item %s to table %s" % (dumps(key), table))
         self.request_items[table].append({"delete_item": {"Key": key}})
 
-    def batch_read(self):
-        n = 0
+    def _read_chunks(self):
+        """Split the queued keys into request items of at most 100 keys."""
+        keys = [
+            (table, key)
+            for table, request in self.get_serialized_items.items()
+            for key in request["Keys"]
+        ]
+        for i in range(0, len(keys), BATCH_READ_LIMIT):
+            request_items = {}
+            for table, key in keys[i : i + BATCH_READ_LIMIT]:
+                if table not in request_items:
+                    request_items[table] = dict(self.get_serialized_items[table])
+                    request_items[table]["Keys"] = []
+                request_items[table]["Keys"].append(key)
+            yield request_items
+
+    def _read_chunk(self, request_items):
         results = {}
-        # serialize
-        response = self.client.batch_get_item(RequestItems=self.get_serialized_items)
-        results.update(response["Responses"])
-        while response["UnprocessedKeys"]:
-            # Implement some kind of exponential back off here
-            n = n + 1
-            time.sleep((2**n) + random.randint(0, 1000) / 1000)
-            response = self.client.batch_get_item(
-                RequestItems=response["UnprocessedKeys"]
-            )
-            results.update(response["Responses"])
-        for table, records in dict(results).items():
-            results[table] = [deserialize_output(r) for r in records]
+        attempt = 0
+        while request_items:
+            response = self.client.batch_get_item(RequestItems=request_items)
+            for table, records in response["Responses"].items():
+                results.setdefault(table, []).extend(records)
+            request_items = response.get("UnprocessedKeys")
+            if request_items:
+                backoff_sleep(attempt)
+                attempt += 1
+        return results
+
+    def iter_batch_read(self, max_workers=4):
+        """Yield (table, item) pairs as each 100-key chunk comes back."""
+        chunks = list(self._read_chunks())
+        if not chunks:
+            return
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor:
+            futures = [executor.submit(self._read_chunk, chunk) for chunk in chunks]
+            for future in as_completed(futures):
+                for table, records in future.result().items():
+                    for item in deserialize_items(records):
+                        yield table, item
+
+    def batch_read(self, max_workers=4):
+        results = {table: [] for table in self.get_serialized_items}
+        for table, item in self.iter_batch_read(max_workers=max_workers):
+            results.setdefault(table, []).append(item)
         return results
 
-    def batch_write(self):
-        table_ct, delete_ct, put_ct = 0, 0, 0
-        for table_name, records in self.request_items.items():
-            table_ct += 1
-            table = self.resource_client.Table(table_name)
-            with table.batch_writer() as batch:
-                for record in records:
-                    if "put_item" in record:
-                        put_ct += 1
-                        item = record["put_item"]["Item"]
-                        logger.debug(
-                            "Adding item %s to table %s" % (dumps(item), table_name)
-                        )
-                        if not self.dry_run:
-                            batch.put_item(Item=item)
-                    elif "delete_item" in record:
-                        delete_ct += 1
-                        key = record["delete_item"]["Key"]
-                        logger.debug(
-                            "Deleting key %s from table %s" % (dumps(key), table_name)
-                        )
-                        if not self.dry_run:
-                            batch.delete_item(Key=key)
+    def _table_key_names(self, table_name, records):
+        """Key attribute names given by the caller, else those of a queued
+        delete, else from DescribeTable. Dry runs never call DescribeTable."""
+        if table_name in self.key_names:
+            return self.key_names[table_name]
+        for record in records:
+            if "delete_item" in record:
+                return sorted(record["delete_item"]["Key"])
+        if self.dry_run:
+            return None
+        return describe_key_names(table_name)
+
+    def _write_table(self, table_name, records):
+        """Deduplicate and write one table's queued records. Without key
+        names the records are written as queued."""
+        names = self._table_key_names(table_name, records)
+        requests = {}
+        for index, record in enumerate(records):
+            if "put_item" in record:
+                item = record["put_item"]["Item"]
+                request = {"PutRequest": {"Item": item}}
+            else:
+                item = record["delete_item"]["Key"]
+                request = {"DeleteRequest": {"Key": item}}
+            if names is None:
+                requests[index] = request
+                continue
+            # last operation on a key wins, a batch may not touch a key twice
+            key = tuple(dumps(item[name], sort_keys=True) for name in names)
+            requests.pop(key, None)
+            requests[key] = request
+        requests = list(requests.values())
+        report = {
+            "puts": sum(1 for r in requests if "PutRequest" in r),
+            "deletes": sum(1 for r in requests if "DeleteRequest" in r),
+            "duplicates": len(records) - len(requests),
+            "unprocessed": [],
+            "consumed_wcu": 0,
+        }
+        if self.dry_run:
+            for request in requests:
+                logger.debug("Dry run %s on table %s" % (dumps(request), table_name))
+            return report
+        client = self.resource_client.meta.client
+        for i in range(0, len(requests), BATCH_WRITE_LIMIT):
+            chunk = requests[i : i + BATCH_WRITE_LIMIT]
+            attempt = 0
+            while chunk:
+                response = client.batch_write_item(
+                    RequestItems={table_name: chunk},
+                    ReturnConsumedCapacity="TOTAL",
+                )
+                for capacity in response.get("ConsumedCapacity", []):
+                    report["consumed_wcu"] += capacity.get("CapacityUnits", 0)
+                chunk = response.get("UnprocessedItems", {}).get(table_name, [])
+                if chunk and attempt >= BATCH_WRITE_RETRIES:
+                    logger.warning(
+                        "%s item(s) still unprocessed for table %s after %s retries"
+                        % (len(chunk), table_name, BATCH_WRITE_RETRIES)
+                    )
+                    report["unprocessed"].extend(chunk)
+                    break
+                if chunk:
+                    backoff_sleep(attempt)
+                    attempt += 1
+        return report
+
+    def batch_write(self, max_workers=8):
+        """Write the queued items, one concurrent flush per table.
+
+        Returns {table: {puts, deletes, duplicates, unprocessed, consumed_wcu}}
+        and raises UnprocessedItemsError, after every table has been written,
+        when any items are left unprocessed.
+        """
+        if not self.request_items:
+            return {}
+        with ThreadPoolExecutor(
+            max_workers=min(max_workers, len(self.request_items))
+        ) as executor:
+            futures = {
+                table_name: executor.submit(self._write_table, table_name, records)
+                for table_name, records in self.request_items.items()
+            }
+            reports = {name: future.result() for name, future in futures.items()}
         logger.debug(
             "Wrote %s items and deleted %s items from %s tables"
-            % (put_ct, delete_ct, table_ct)
+            % (
+                sum(r["puts"] for r in reports.values()),
+                sum(r["deletes"] for r in reports.values()),
+                len(reports),
+            )
         )
+        if any(report["unprocessed"] for report in reports.values()):
+            raise UnprocessedItemsError(reports)
+        return reports
@@ -0,0 +1,257 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from py_tools.pylog import get_logger
+
+logger = get_logger("py-tools.dydb_buffer")
+
+
+class _Scope:
+    """Pending writes and failures of one lambda invocation, per buffer."""
+
+    def __init__(self):
+        self.pending = {}
+        self.failures = []
+        self.lock = threading.Lock()
+
+
+# writes outside write_buffer_scope() share the process scope; a contextvar
+# keeps concurrent invocations (e.g. replay drains) from flushing each other's
+_process_scope = _Scope()
+_scope = ContextVar("write_buffer_scope", default=_process_scope)
+# records whose processing queues the current writes, failed with them
+_sources = ContextVar("write_buffer_sources", default=())
+
+
+@contextmanager
+def write_buffer_scope():
+    """Keep the writes buffered inside the block to this invocation."""
+    token = _scope.set(_Scope())
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+@contextmanager
+def write_buffer_sources(records):
+    """Attribute writes buffered inside the block to records."""
+    token = _sources.set(tuple(records))
+    try:
+        yield
+    finally:
+        _sources.reset(token)
+
+
+def _overlaps(a, b):
+    return a == b or a.startswith(b + ".") or b.startswith(a + ".")
+
+
+class _Pending:
+    """Merged update_item arguments for one key."""
+
+    def __init__(self, overwrite):
+        self.overwrite = overwrite
+        self.created = time.monotonic()
+        self.sources = {}
+        self.ops = {
+            "updates": {},
+            "adds": {},
+            "appends": {},
+            "prepends": {},
+            "deletes": {},
+            "removes": {},
+        }
+
+    def conflicts(self, ops):
+        """True when ops touch a path that cannot share one update expression
+        with what is already pending."""
+        for kind, values in ops.items():
+            for path, value in values.items():
+                for other_kind, other_values in self.ops.items():
+                    for other_path in other_values:
+                        if not _overlaps(path, other_path):
+                            continue
+                        if path != other_path or kind != other_kind:
+                            return True
+                        if kind == "adds" and not _addable(
+                            other_values[path], value
+                        ):
+                            return True
+        return False
+
+    def merge(self, ops, sources=()):
+        for record in sources:
+            self.sources[id(record)] = record
+        for kind, values in ops.items():
+            pending = self.ops[kind]
+            for path, value in values.items():
+                if path not in pending:
+                    pending[path] = value
+                elif kind == "adds":
+                    pending[path] = (
+                        pending[path] | value
+                        if isinstance(value, (set, frozenset))
+                        else pending[path] + value
+                    )
+                elif kind == "appends":
+                    pending[path] = list(pending[path]) + list(value)
+                elif kind == "prepends":
+                    pending[path] = list(value) + list(pending[path])
+                elif kind == "deletes":
+                    pending[path] = set(pending[path]) | set(value)
+                else:
+                    pending[path] = value
+
+
+def _addable(a, b):
+    if isinstance(a, (set, frozenset)):
+        return isinstance(b, (set, frozenset))
+    return not isinstance(b, (set, frozenset, bool)) and not isinstance(a, bool)
+
+
+class WriteBuffer:
+    """Write-behind buffer coalescing DbModel.update_item calls per key.
+
+    Enable it per model with ``write_buffer = WriteBuffer(max_items=100,
+    max_age=2)``. Buffered calls return an unsaved model holding only the
+    key. Pending writes are flushed once max_items keys are buffered, when
+    the oldest is max_age seconds old, before DbModel gets, queries, batch
+    gets or writes that may touch the same key, and when the lambda handler
+    returns. Writes are kept per invocation (see write_buffer_scope). Failed
+    writes are not raised into whichever caller triggered the flush; they
+    are collected and returned by flush_write_buffers() with the records
+    that queued them, which the handler then fails.
+    """
+
+    def __init__(self, max_items=100, max_age=2.0):
+        self.max_items = max_items
+        self.max_age = max_age
+
+    def _state(self):
+        scope = _scope.get()
+        return scope, scope.pending.setdefault(self, {})
+
+    def add(
+        self,
+        model_cls,
+        hash_key,
+        range_key,
+        overwrite=False,
+        updates=None,
+        deletes=None,
+        adds=None,
+        appends=None,
+        prepends=None,
+    ):
+        """Buffer an update_item call, returns False if it cannot be merged."""
+        if isinstance(deletes, dict):
+            deletes, removes = deletes, {}
+        else:
+            deletes, removes = {}, {path: None for path in deletes or []}
+        ops = {
+            "updates": updates or {},
+            "adds": adds or {},
+            "appends": appends or {},
+            "prepends": prepends or {},
+            "deletes": deletes,
+            "removes": removes,
+        }
+        # attribute objects cannot be compared as dict keys
+        if not all(
+            isinstance(path, str) for values in ops.values() for path in values
+        ):
+            return False
+        key = (model_cls, hash_key, range_key)
+        scope, buffered = self._state()
+        while True:
+            flush = []
+            with scope.lock:
+                pending = buffered.get(key)
+                if pending is not None and (
+                    pending.overwrite != overwrite or pending.conflicts(ops)
+                ):
+                    # write what is pending first, then buffer this call
+                    flush.append((key, buffered.pop(key)))
+                else:
+                    if pending is None:
+                        pending = buffered[key] = _Pending(overwrite)
+                    pending.merge(ops, _sources.get())
+                    oldest = next(iter(buffered.values()))
+                    if (
+                        len(buffered) >= self.max_items
+                        or time.monotonic() - oldest.created >= self.max_age
+                    ):
+                        flush.extend(buffered.items())
+                        buffered.clear()
+                    break
+            self._write(scope, flush)
+        self._write(scope, flush)
+        return True
+
+    def flush_key(self, model_cls, hash_key, range_key=None):
+        scope, buffered = self._state()
+        with scope.lock:
+            pending = buffered.pop((model_cls, hash_key, range_key), None)
+        if pending is not None:
+            self._write(scope, [((model_cls, hash_key, range_key), pending)])
+
+    def flush_model(self, model_cls, hash_key=None):
+        """Flush the pending writes of model_cls, or of one of its hash keys."""
+        scope, buffered = self._state()
+        with scope.lock:
+            flush = [
+                (key, pending)
+                for key, pending in buffered.items()
+                if key[0] is model_cls and (hash_key is None or key[1] == hash_key)
+            ]
+            for key, _ in flush:
+                del buffered[key]
+        self._write(scope, flush)
+
+    def flush(self):
+        """Write everything pending in the current scope."""
+        scope, buffered = self._state()
+        with scope.lock:
+            flush = list(buffered.items())
+            buffered.clear()
+        self._write(scope, flush)
+
+    def _write(self, scope, flush):
+        for (model_cls, hash_key, range_key), pending in flush:
+            ops = pending.ops
+            try:
+                model_cls._update_item(
+                    hash_key,
+                    range_key,
+                    updates=ops["updates"],
+                    deletes=ops["deletes"],
+                    adds=ops["adds"],
+                    appends=ops["appends"],
+                    prepends=ops["prepends"],
+                    actions=[model_cls.deletes(path) for path in ops["removes"]],
+                    overwrite=pending.overwrite,
+                )
+            except Exception as e:
+                logger.error(
+                    "Buffered update of %s %s failed: %s"
+                    % (model_cls.__name__, (hash_key, range_key), e)
+                )
+                with scope.lock:
+                    scope.failures.append((list(pending.sources.values()), e))
+
+
+def flush_write_buffers():
+    """Flush every WriteBuffer of the current scope, called when a lambda
+    handler returns. Returns (records, error) pairs for the writes that
+    failed since the last call, records being those that queued them."""
+    scope = _scope.get()
+    with scope.lock:
+        buffers = list(scope.pending)
+    for buffer in buffers:
+        buffer.flush()
+    with scope.lock:
+        failures, scope.failures = scope.failures, []
+    return failures
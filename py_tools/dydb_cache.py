@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CachedResults(list):
+    """Query results served from a ModelCache, keeping last_evaluated_key."""
+
+    def __init__(self, items, last_evaluated_key=None):
+        super(CachedResults, self).__init__(items)
+        self.last_evaluated_key = last_evaluated_key
+
+
+class ModelCache:
+    """Size and TTL bounded read-through cache for a DbModel.
+
+    Enable it per model with ``read_cache = ModelCache(maxsize=1024, ttl=60)``.
+    Items are kept in their serialized DynamoDB form so every hit builds a
+    fresh model instance.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (found, value) for key."""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._items[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, hash_key):
+        """Drop cached gets and queries for hash_key, and every index query
+        since their keys cannot be matched to the written item."""
+        with self._lock:
+            stale = [
+                key
+                for key in self._items
+                if key[1] == hash_key or (key[0] == "query" and key[2] is not None)
+            ]
+            for key in stale:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._items),
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
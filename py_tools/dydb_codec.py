@@ -0,0 +1,196 @@
+import base64
+from collections.abc import Mapping, Set
+from decimal import Decimal
+
+from boto3.dynamodb.types import Binary
+
+
+class CodecError(ValueError):
+    """Raised when a value cannot be converted, with the attribute path."""
+
+    def __init__(self, path, reason):
+        self.path = path
+        self.reason = reason
+        super(CodecError, self).__init__("%s: %s" % (path, reason))
+
+
+def _number(policy):
+    if policy == "auto":
+        # DynamoDB normalizes numbers, so anything with a fraction or an
+        # exponent is not integral
+        def convert(value):
+            try:
+                return int(value)
+            except ValueError:
+                return float(value)
+
+        return convert
+    if policy == "decimal":
+        return Decimal
+    if policy == "float":
+        return float
+    raise ValueError("numbers must be one of auto, decimal or float")
+
+
+def _binary(value):
+    # stream events carry binary values base64 encoded
+    if isinstance(value, str):
+        value = base64.b64decode(value)
+    return Binary(value)
+
+
+def _deserializers(number):
+    def map_(data):
+        return {k: deserialize(v, k) for k, v in data.items()}
+
+    def list_(data):
+        return [deserialize(v, i) for i, v in enumerate(data)]
+
+    dispatch = {
+        "S": str,
+        "N": number,
+        "BOOL": bool,
+        "NULL": lambda data: None,
+        "B": _binary,
+        "M": map_,
+        "L": list_,
+        "SS": set,
+        "NS": lambda data: {number(v) for v in data},
+        "BS": lambda data: {_binary(v) for v in data},
+    }
+
+    def deserialize(value, path):
+        try:
+            (type_, data), = value.items()
+            return dispatch[type_](data)
+        except CodecError as e:
+            raise CodecError("%s.%s" % (path, e.path), e.reason)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise CodecError(path, "cannot deserialize %r (%s)" % (value, e))
+
+    return deserialize
+
+
+_DESERIALIZE = {
+    policy: _deserializers(_number(policy)) for policy in ("auto", "decimal", "float")
+}
+
+
+def deserialize_item(item, numbers="auto"):
+    """Plain python dict for a DynamoDB wire-format item, without touching it.
+
+    numbers is "auto" (int when integral, float otherwise), "decimal" or
+    "float".
+    """
+    try:
+        deserialize = _DESERIALIZE[numbers]
+    except KeyError:
+        raise ValueError("numbers must be one of auto, decimal or float")
+    return {k: deserialize(v, k) for k, v in item.items()}
+
+
+def deserialize_items(items, numbers="auto"):
+    """deserialize_item for a batch, errors carry the item index."""
+    try:
+        deserialize = _DESERIALIZE[numbers]
+    except KeyError:
+        raise ValueError("numbers must be one of auto, decimal or float")
+    output = []
+    for index, item in enumerate(items):
+        try:
+            output.append({k: deserialize(v, k) for k, v in item.items()})
+        except CodecError as e:
+            raise CodecError("[%s].%s" % (index, e.path), e.reason)
+    return output
+
+
+def _serialize_number(value):
+    if isinstance(value, int):
+        return {"N": str(int(value))}
+    if isinstance(value, float):
+        value = Decimal(repr(value))
+    if not value.is_finite():
+        raise ValueError("infinity and NaN are not supported")
+    return {"N": str(value)}
+
+
+def _serialize_set(value, path):
+    if not value:
+        raise CodecError(path, "empty sets are not supported")
+    if all(isinstance(v, str) for v in value):
+        return {"SS": list(value)}
+    if all(
+        isinstance(v, (int, float, Decimal)) and not isinstance(v, bool) for v in value
+    ):
+        return {"NS": [_serialize_number(v)["N"] for v in value]}
+    if all(isinstance(v, (bytes, bytearray, Binary)) for v in value):
+        return {"BS": [bytes(v.value if isinstance(v, Binary) else v) for v in value]}
+    raise CodecError(path, "sets must hold only strings, numbers or binary")
+
+
+def _serialize(value, path):
+    serializer = _SERIALIZERS.get(type(value))
+    if serializer is not None:
+        return serializer(value, path)
+    if isinstance(value, bool):
+        return {"BOOL": value}
+    if isinstance(value, str):
+        return {"S": str(value)}
+    if isinstance(value, (int, float, Decimal)):
+        return _checked_number(value, path)
+    if isinstance(value, Mapping):
+        return _serialize_map(value, path)
+    if isinstance(value, Set):
+        return _serialize_set(value, path)
+    if isinstance(value, (list, tuple)):
+        return _serialize_list(value, path)
+    raise CodecError(path, "unsupported type %s" % type(value).__name__)
+
+
+def _serialize_map(value, path):
+    return {"M": {k: _serialize(v, "%s.%s" % (path, k)) for k, v in value.items()}}
+
+
+def _serialize_list(value, path):
+    return {"L": [_serialize(v, "%s.%s" % (path, i)) for i, v in enumerate(value)]}
+
+
+def _checked_number(value, path):
+    try:
+        return _serialize_number(value)
+    except ValueError as e:
+        raise CodecError(path, str(e))
+
+
+_SERIALIZERS = {
+    str: lambda value, path: {"S": value},
+    bool: lambda value, path: {"BOOL": value},
+    int: lambda value, path: {"N": str(value)},
+    float: _checked_number,
+    Decimal: _checked_number,
+    type(None): lambda value, path: {"NULL": True},
+    bytes: lambda value, path: {"B": value},
+    bytearray: lambda value, path: {"B": bytes(value)},
+    Binary: lambda value, path: {"B": value.value},
+    dict: _serialize_map,
+    list: _serialize_list,
+    tuple: _serialize_list,
+    set: _serialize_set,
+    frozenset: _serialize_set,
+}
+
+
+def serialize_item(item):
+    """DynamoDB wire-format dict for a plain python item, without touching it."""
+    return {k: _serialize(v, k) for k, v in item.items()}
+
+
+def serialize_items(items):
+    """serialize_item for a batch, errors carry the item index."""
+    output = []
+    for index, item in enumerate(items):
+        try:
+            output.append({k: _serialize(v, k) for k, v in item.items()})
+        except CodecError as e:
+            raise CodecError("[%s].%s" % (index, e.path), e.reason)
+    return output
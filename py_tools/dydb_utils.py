@@ -1,65 +1,225 @@
+import queue
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from functools import cached_property, lru_cache
+
+from py_tools.dydb_codec import deserialize_item, deserialize_items, serialize_item
 
-from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
-from decimal import Decimal
 
 def deserialize_output(value):
-    td = TypeDeserializer()
-    try:
-        for k, v in dict(value).items():
-            py_val = td.deserialize(v)
-            if isinstance(py_val, Decimal):
-                py_val = int(py_val)
-            value[k] = py_val
-    except BaseException:
-        pass
-    return value
+    return deserialize_item(value)
+
 
 def serialize_input(value):
-    td = TypeSerializer()
-    try:
-        for k, v in dict(value).items():
-            value[k] = td.serialize(v)
-    except BaseException:
-        pass
-    return value
-
-def get_all_items(table, attributes_to_get=None):
-    last_evaluated_key = None
-    items = []
-
-    while True:
-        results = table.scan(
-            last_evaluated_key=last_evaluated_key,
-            attributes_to_get=attributes_to_get,
+    return serialize_item(value)
+
+
+def _scan_segment(
+    table, segment, total_segments, start_key, rate_limit, attributes_to_get, as_dicts
+):
+    """Yield (items, last_evaluated_key) for each page of one scan segment."""
+    results = table.scan(
+        segment=segment,
+        total_segments=total_segments,
+        last_evaluated_key=start_key,
+        rate_limit=rate_limit,
+        attributes_to_get=attributes_to_get,
+    )
+    for page in results.page_iter:
+        if as_dicts:
+            items = deserialize_items(page.get("Items", []))
+        else:
+            items = [table.from_raw_data(item) for item in page.get("Items", [])]
+        yield items, results.page_iter.last_evaluated_key
+
+
+def get_all_items(
+    table,
+    attributes_to_get=None,
+    segments=1,
+    rate_limit=None,
+    checkpoint=None,
+    on_checkpoint=None,
+    as_dicts=False,
+):
+    """Stream every item of a model's table.
+
+    segments > 1 runs a parallel scan with one worker per segment, and
+    rate_limit caps the consumed read capacity per second across them.
+    on_checkpoint(segment, last_evaluated_key) is called once a page has
+    been consumed, with None when the segment is finished; pass the
+    collected {segment: last_evaluated_key} back as checkpoint to resume.
+    as_dicts yields plain dicts straight from the wire format instead of
+    building model instances.
+    """
+    checkpoint = checkpoint or {}
+    on_checkpoint = on_checkpoint or (lambda segment, key: None)
+    pending = [
+        segment
+        for segment in range(segments)
+        if segment not in checkpoint or checkpoint[segment] is not None
+    ]
+    if not pending:
+        return
+    segment_rate = rate_limit / segments if rate_limit else None
+
+    def pages(segment):
+        return _scan_segment(
+            table,
+            segment if segments > 1 else None,
+            segments if segments > 1 else None,
+            checkpoint.get(segment),
+            segment_rate,
+            attributes_to_get,
+            as_dicts,
         )
-        for item in results:
-            items.append(item)
 
-        if results.last_evaluated_key is None:
-            break
+    if segments == 1:
+        for items, last_evaluated_key in pages(0):
+            yield from items
+            on_checkpoint(0, last_evaluated_key)
+        return
+
+    # bounded so a slow consumer holds back the scan instead of memory
+    pages_queue = queue.Queue(maxsize=len(pending) * 2)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                pages_queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-        last_evaluated_key = results.last_evaluated_key
+    def worker(segment):
+        try:
+            for items, last_evaluated_key in pages(segment):
+                if not put((segment, items, last_evaluated_key, None)):
+                    return
+        except Exception as e:
+            put((segment, None, None, e))
+
+    executor = ThreadPoolExecutor(
+        max_workers=len(pending), thread_name_prefix="py-tools-scan"
+    )
+    try:
+        for segment in pending:
+            executor.submit(worker, segment)
+        remaining = len(pending)
+        while remaining:
+            segment, items, last_evaluated_key, error = pages_queue.get()
+            if error is not None:
+                raise error
+            yield from items
+            on_checkpoint(segment, last_evaluated_key)
+            if last_evaluated_key is None:
+                remaining -= 1
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
 
-    return items
+
+@lru_cache(maxsize=None)
+def stream_table(event_source_arn):
+    """Return (table_name, trigger_module) for a stream ARN, memoized."""
+    table_name = event_source_arn.split("/")[-3]
+    trigger_module = "_".join(re.findall("[A-Z][^A-Z]*", table_name)).lower()
+    return table_name, trigger_module
 
 
 class StreamRecord:
 
     def __init__(self, record):
-        self.key = deserialize_output(record["dynamodb"]["Keys"])
-        self.new_image = deserialize_output(
-            record["dynamodb"].get("NewImage", {})
-        )
-        self.old_image = deserialize_output(
-            record["dynamodb"].get("OldImage", {})
-        )
+        self.record = record
         self.event_name = record["eventName"].lower()
-        self.table_name = record["eventSourceARN"].split("/")[-3]
-        self.trigger_module = "_".join(
-            re.findall("[A-Z][^A-Z]*", self.table_name)
-        ).lower()
+        self.table_name, self.trigger_module = stream_table(record["eventSourceARN"])
         if record.get("userIdentity", {}).get("type", "") == "Service":
             self.ttl = True
         else:
             self.ttl = False
+
+    # images are only deserialized when a route reads them
+    @cached_property
+    def key(self):
+        return deserialize_item(self.record["dynamodb"]["Keys"])
+
+    @cached_property
+    def new_image(self):
+        return deserialize_item(self.record["dynamodb"].get("NewImage", {}))
+
+    @cached_property
+    def old_image(self):
+        return deserialize_item(self.record["dynamodb"].get("OldImage", {}))
+
+
+class StreamRecords:
+    """Wraps each record of a batch once so the batch and individual paths
+    share the same StreamRecord objects."""
+
+    def __init__(self, wrapper=None):
+        self.wrapper = wrapper or StreamRecord
+        self._records = {}
+
+    def __call__(self, record):
+        stream_record = self._records.get(id(record))
+        if stream_record is None:
+            stream_record = self._records[id(record)] = self.wrapper(record)
+        return stream_record
+
+
+def _stream_key(record):
+    keys = record["dynamodb"]["Keys"]
+    return record["eventSourceARN"], tuple(
+        sorted((name, tuple(value.items())) for name, value in keys.items())
+    )
+
+
+def compact_stream_records(records):
+    """Collapse stream records for the same item into their net transition.
+    The first OldImage and last NewImage are kept, INSERT followed by REMOVE
+    cancels out, and the original sequence numbers are listed under
+    CompactedSequenceNumbers with the earliest one as SequenceNumber.
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault(_stream_key(record), []).append(record)
+
+    compacted = []
+    for group in groups.values():
+        if len(group) == 1:
+            compacted.append(group[0])
+            continue
+
+        first, last = group[0], group[-1]
+        first_event, last_event = first["eventName"], last["eventName"]
+        if first_event == "INSERT" and last_event == "REMOVE":
+            continue
+        if first_event == "INSERT":
+            event_name = "INSERT"
+        elif last_event == "REMOVE":
+            event_name = "REMOVE"
+        else:
+            event_name = "MODIFY"
+
+        record = deepcopy(last)
+        record["eventName"] = event_name
+        stream = record["dynamodb"]
+        stream.pop("OldImage", None)
+        if event_name != "INSERT" and "OldImage" in first["dynamodb"]:
+            stream["OldImage"] = first["dynamodb"]["OldImage"]
+        if event_name == "REMOVE":
+            stream.pop("NewImage", None)
+        sequence_numbers = [
+            r["dynamodb"]["SequenceNumber"]
+            for r in group
+            if "SequenceNumber" in r["dynamodb"]
+        ]
+        if sequence_numbers:
+            stream["SequenceNumber"] = sequence_numbers[0]
+            stream["CompactedSequenceNumbers"] = sequence_numbers
+        compacted.append(record)
+    return compacted
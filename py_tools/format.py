@@ -26,6 +26,13 @@ def dumps(*args, **kwargs):
     return simplejson.dumps(*args, **kwargs)
 
 
+def iterdumps(obj, **kwargs):
+    """Like dumps, but yields the encoded JSON in chunks."""
+    kwargs.setdefault("use_decimal", True)
+    cls = kwargs.pop("cls", ModelEncoder)
+    return cls(**kwargs).iterencode(obj)
+
+
 def clean_empty(d):
     if not isinstance(d, (dict, list)):
         return d
@@ -1,52 +1,294 @@
+import asyncio
+import contextvars
 import importlib.util
+import inspect
 import os
-from py_tools.dydb_utils import StreamRecord
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from py_tools.dydb_buffer import (
+    flush_write_buffers,
+    write_buffer_scope,
+    write_buffer_sources,
+)
+from py_tools.dydb_utils import (
+    StreamRecord,
+    StreamRecords,
+    compact_stream_records,
+    stream_table,
+)
 import traceback
 import sentry_sdk
 import gzip
 import base64
-from py_tools.format import dumps, loads
-import tempfile
+import hashlib
+import io
+import math
+from py_tools.format import dumps, iterdumps, loads
 import uuid
-from py_tools.s3 import upload_file
+from py_tools.s3 import upload_fileobj
+from py_tools.sqs import Sqs
 from py_tools.pylog import get_logger
 
 
 logger = get_logger("py-tools.handler")
 
+# Replay payloads up to this size (base64 encoded) stay inline in ReplayBin,
+# safely under the 400KB DynamoDB item limit; larger ones go to S3
+INLINE_RECORD_LIMIT = 350 * 1024
+
+
+def gzip_json(json_data):
+    """Stream json_data as compact JSON into an in-memory gzip buffer."""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as gz:
+        text = io.TextIOWrapper(gz, encoding="utf-8")
+        for chunk in iterdumps(json_data, separators=(",", ":")):
+            text.write(chunk)
+        text.flush()
+        text.detach()
+    buffer.seek(0)
+    return buffer
+
 
 def compress_json(json_data):
-    json_string = dumps(json_data, separators=(",", ":"))
-    compressed_data = gzip.compress(json_string.encode())
-    compressed_string = base64.b64encode(compressed_data).decode()
-    return compressed_string
+    return base64.b64encode(gzip_json(json_data).getvalue()).decode()
+
+
+def store_archive_s3(payloads, s3_bucket, s3_key_prefix="replay"):
+    """Store gzipped payloads back to back in one S3 object, each one a
+    complete gzip member. Returns the s3_uri and each payload's
+    (offset, length) for ranged reads.
+    """
+    buffer = io.BytesIO()
+    ranges = []
+    for payload in payloads:
+        data = payload.getvalue()
+        ranges.append((buffer.tell(), len(data)))
+        buffer.write(data)
+    buffer.seek(0)
+    key = f"{s3_key_prefix}/{uuid.uuid4()}.pack.gz"
+    upload_fileobj(buffer, s3_bucket, key, ContentType="application/octet-stream")
+    return f"s3://{s3_bucket}/{key}", ranges
 
 
-def store_record_s3(record, s3_bucket, s3_key_prefix="replay"):
-    """Store record as uncompressed JSON in S3, return s3_uri."""
+def store_record_s3(record, s3_bucket, s3_key_prefix="replay", payload=None):
+    """Store record as gzipped JSON in S3, return s3_uri."""
     uid = uuid.uuid4()
-    key = f"{s3_key_prefix}/{uid}.json"
-    with tempfile.NamedTemporaryFile(mode="w", delete=True) as f:
-        f.write(dumps(record))
-        f.flush()
-        upload_file(f.name, s3_bucket, key)
+    key = f"{s3_key_prefix}/{uid}.json.gz"
+    upload_fileobj(
+        payload or gzip_json(record),
+        s3_bucket,
+        key,
+        ContentType="application/json",
+        ContentEncoding="gzip",
+    )
     return f"s3://{s3_bucket}/{key}"
 
 
-class BaseHandler:
-    """Base handler with common functionality for single and batch processing"""
+# Route modules loaded once per container, keyed by
+# (folder, module_name, realpath, mtime) so an edited file is picked up again
+_route_modules = {}
+_route_modules_lock = threading.Lock()
 
-    @staticmethod
-    def module_handler(file, module_name, folder="sqs"):
-        path = os.path.dirname(os.path.realpath(file)) + "/{}/{}.py".format(
-            folder, module_name
-        )
+
+def route_path(file, module_name, folder="sqs"):
+    return os.path.dirname(os.path.realpath(file)) + "/{}/{}.py".format(
+        folder, module_name
+    )
+
+
+def load_route_module(file, module_name, folder="sqs"):
+    """Return the route module for folder/module_name, executing it only once."""
+    path = route_path(file, module_name, folder)
+    key = (folder, module_name, path, os.path.getmtime(path))
+    m = _route_modules.get(key)
+    if m is not None:
+        return m
+
+    with _route_modules_lock:
+        m = _route_modules.get(key)
+        if m is not None:
+            return m
         name = path.split("/")[-1].replace(".py", "")
         logger.debug("Loading module %s.%s from %s", folder, module_name, path)
         spec = importlib.util.spec_from_file_location(name, path)
         m = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(m)
-        return m
+        # drop stale versions of the same file
+        for stale in [k for k in _route_modules if k[:3] == key[:3]]:
+            del _route_modules[stale]
+        _route_modules[key] = m
+    return m
+
+
+def preload_routes(file, folders=("sqs", "dynamodb", "adhoc")):
+    """Load every route module under the given folders, e.g. at cold start."""
+    loaded = 0
+    base = os.path.dirname(os.path.realpath(file))
+    for folder in folders:
+        folder_path = os.path.join(base, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for filename in sorted(os.listdir(folder_path)):
+            if not filename.endswith(".py") or filename.startswith("_"):
+                continue
+            load_route_module(file, filename[:-3], folder=folder)
+            loaded += 1
+    logger.info("Preloaded %d route module(s)", loaded)
+    return loaded
+
+
+# Worker pools shared across warm invocations, one per use and size
+_executors = {}
+_executors_lock = threading.Lock()
+
+# Workers running the functions of an Independent event list
+INDEPENDENT_FUNCTION_WORKERS = 8
+
+
+def get_executor(max_workers, name="records"):
+    with _executors_lock:
+        executor = _executors.get((name, max_workers))
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix=f"py-tools-{name}"
+            )
+            _executors[(name, max_workers)] = executor
+    return executor
+
+
+class Independent(list):
+    """Event function list whose functions do not depend on each other and
+    may run concurrently for the same stream record, e.g.
+
+        modify = Independent([index_search, refresh_cache, send_webhooks])
+    """
+
+
+def ordering_key(record):
+    """Return the key records must stay ordered by, or None when unordered.
+    SQS FIFO records are ordered per MessageGroupId and DynamoDB stream
+    records per item key.
+    """
+    message_group_id = record.get("attributes", {}).get("MessageGroupId")
+    if message_group_id is not None:
+        return record.get("eventSourceARN"), message_group_id
+    keys = record.get("dynamodb", {}).get("Keys")
+    if keys is not None:
+        return record.get("eventSourceARN"), dumps(keys, sort_keys=True)
+    return None
+
+
+def group_records(records):
+    """Split records into ordered groups that may run independently."""
+    groups = {}
+    for index, record in enumerate(records):
+        key = ordering_key(record)
+        if key is None:
+            key = ("unordered", index)
+        groups.setdefault(key, []).append(record)
+    return list(groups.values())
+
+
+def _process_group(group, process):
+    for record in group:
+        process(record)
+
+
+def _process_records(records, process, concurrency=None):
+    """Run process(record) for every record, concurrently across ordering
+    groups when concurrency is above 1.
+    """
+    if not concurrency or concurrency < 2 or len(records) < 2:
+        _process_group(records, process)
+        return
+
+    groups = group_records(records)
+    logger.debug(
+        "Processing %d record(s) in %d group(s) with concurrency %d",
+        len(records),
+        len(groups),
+        concurrency,
+    )
+    executor = get_executor(concurrency)
+    futures = [
+        executor.submit(contextvars.copy_context().run, _process_group, group, process)
+        for group in groups
+    ]
+    for future in futures:
+        future.result()
+
+
+# Event loop reused across warm invocations for async routes
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+    return _event_loop
+
+
+def run_async(awaitable):
+    """Run awaitable to completion on the container event loop."""
+    with _event_loop_lock:
+        return get_event_loop().run_until_complete(awaitable)
+
+
+def resolve_awaitable(value):
+    if inspect.isawaitable(value):
+        return run_async(value)
+    return value
+
+
+async def _process_records_async(records, process, concurrency=None):
+    """Await process(record) for every record, at most concurrency at a time,
+    keeping records of the same ordering group in order.
+    """
+    semaphore = asyncio.Semaphore(max(concurrency or 1, 1))
+
+    async def run_group(group):
+        for record in group:
+            async with semaphore:
+                await process(record)
+
+    await asyncio.gather(*[run_group(group) for group in group_records(records)])
+
+
+def is_async_route(file, record, source_handler, dydb_wrapper=None):
+    """Return True when the route module for record exposes async handlers."""
+    try:
+        if source_handler == "dynamodb":
+            stream_record = (dydb_wrapper or StreamRecord)(record)
+            m = load_route_module(
+                file, stream_record.trigger_module, folder="dynamodb"
+            )
+            functions = [
+                function
+                for event_name in ("insert", "modify", "remove")
+                for function in getattr(m, event_name, [])
+            ]
+        elif source_handler == "sqs":
+            module_name = record["eventSourceARN"].split(":")[-1].replace(".fifo", "")
+            m = load_route_module(file, module_name, folder="sqs")
+            functions = [getattr(m, "handler", None)]
+        else:
+            return False
+    except (OSError, KeyError):
+        # let the regular path load the route and capture the failure
+        return False
+    return any(inspect.iscoroutinefunction(function) for function in functions)
+
+
+class BaseHandler:
+    """Base handler with common functionality for single and batch processing"""
+
+    @staticmethod
+    def module_handler(file, module_name, folder="sqs"):
+        return load_route_module(file, module_name, folder=folder)
 
 
 class Handlers(BaseHandler):
@@ -67,15 +309,21 @@ class Handlers(BaseHandler):
 
         # If target_function_name specified, only run that function
         if target_function_name:
-            for function in functions:
-                if function.__name__ == target_function_name:
-                    function(record, self.context)
-                    break
-        else:
-            for function in functions:
-                function(record, self.context)
+            functions = [f for f in functions if f.__name__ == target_function_name][:1]
+
+        if any(inspect.iscoroutinefunction(function) for function in functions):
+            return self._dynamodb_async(functions, record)
+
+        for function in functions:
+            function(record, self.context)
         return
 
+    async def _dynamodb_async(self, functions, record):
+        for function in functions:
+            output = function(record, self.context)
+            if inspect.isawaitable(output):
+                await output
+
     def sqs(self):
         module_name = self.record["eventSourceARN"].split(":")[-1].replace(".fifo", "")
         m = self.module_handler(self.file, module_name, folder="sqs")
@@ -101,11 +349,13 @@ class BatchHandlers(BaseHandler):
         records,
         context,
         target_function_name=None,
+        dydb_wrapper=None,
     ):
         self.file = file
         self.records = records
         self.context = context
         self.target_function_name = target_function_name
+        self.dydb_wrapper = dydb_wrapper
 
     def sqs(self):
         """Process multiple SQS records as a batch"""
@@ -134,7 +384,8 @@ class BatchHandlers(BaseHandler):
         if not self.records:
             return []
 
-        stream_records = [StreamRecord(r) for r in self.records]
+        wrapper = self.dydb_wrapper or StreamRecord
+        stream_records = [wrapper(r) for r in self.records]
         module_name = stream_records[0].trigger_module
         m = self.module_handler(self.file, module_name, folder="dynamodb")
 
@@ -151,53 +402,234 @@ class BatchHandlers(BaseHandler):
         if self.target_function_name:
             for batch_func in batch_funcs:
                 if batch_func.__name__ == self.target_function_name:
-                    batch_func(stream_records, self.context)
+                    resolve_awaitable(batch_func(stream_records, self.context))
                     break
         else:
             for batch_func in batch_funcs:
-                batch_func(stream_records, self.context)
+                resolve_awaitable(batch_func(stream_records, self.context))
         return True
 
 
+def _logical_content(record):
+    """The part of a record that stays the same across redeliveries."""
+    if record.get("eventSource") == "aws:sqs":
+        return {"queue": record.get("eventSourceARN"), "body": record.get("body")}
+    if "dynamodb" in record:
+        stream = record["dynamodb"]
+        return {
+            "table": stream_table(record["eventSourceARN"])[0],
+            "eventName": record.get("eventName"),
+            "Keys": stream.get("Keys"),
+            "NewImage": stream.get("NewImage"),
+            "OldImage": stream.get("OldImage"),
+        }
+    return record
+
+
+def replay_fingerprint(name, function_name, record):
+    """Hash of a failed record's logical content, ignoring per-delivery
+    fields such as messageId, receipt handles and sequence numbers."""
+    if "Records" in record:
+        content = [_logical_content(r) for r in record["Records"]]
+    else:
+        content = _logical_content(record)
+    hasher = hashlib.sha256(f"{name}|{function_name or ''}|".encode())
+    for chunk in iterdumps(content, separators=(",", ":"), sort_keys=True):
+        hasher.update(chunk.encode())
+    return hasher.hexdigest()
+
+
+def item_identifier(record):
+    """Return the id Lambda expects in batchItemFailures for record."""
+    if "messageId" in record:
+        return record["messageId"]
+    return record.get("dynamodb", {}).get("SequenceNumber")
+
+
 class OutPost:
-    def __init__(self, many=True, s3_bucket=None, s3_key_prefix="replay"):
+    def __init__(
+        self,
+        many=True,
+        s3_bucket=None,
+        s3_key_prefix="replay",
+        report_batch_item_failures=False,
+        deduplicate=False,
+        find_replay=None,
+        pack_s3=False,
+    ):
         self.replays = []
         self.processed = []
         self.many = many
         self.s3_bucket = s3_bucket
         self.s3_key_prefix = s3_key_prefix
+        self.report_batch_item_failures = report_batch_item_failures
+        self.batch_item_failures = {}
+        self.failed_groups = set()
+        self.deferred = []
+        self.deduplicate = deduplicate
+        self.find_replay = find_replay
+        self.fingerprints = {}
+        self.pack_s3 = pack_s3
+        self._archive = []
+        self._lock = threading.Lock()
 
     def __call__(self, many):
         self.many = many
         return self
 
     def add_processed(self, output):
-        self.processed.append(output)
+        with self._lock:
+            self.processed.append(output)
 
     def add_replays(self, output):
-        self.replays.append(output)
+        with self._lock:
+            self.replays.append(output)
+
+    def add_deferred(self, record):
+        with self._lock:
+            self.deferred.append(record)
+
+    def add_batch_item_failures(self, identifiers):
+        with self._lock:
+            for identifier in identifiers:
+                self.batch_item_failures[identifier] = True
+
+    def hold_if_group_failed(self, record):
+        """Report a record without running it when an earlier record of its
+        ordering group (FIFO message group / stream item key) was reported
+        failed, returns True when held."""
+        if not self.failed_groups:
+            return False
+        key = ordering_key(record)
+        if key is None or key not in self.failed_groups:
+            return False
+        self.add_batch_item_failures([item_identifier(record)])
+        return True
+
+    def hold_failed_groups(self, records):
+        """Report every record that follows a failed one in the same ordering
+        group so Lambda redelivers the group in order.
+        """
+        failed_groups = set()
+        for record in records:
+            key = ordering_key(record)
+            if key is None:
+                continue
+            if key in failed_groups:
+                self.add_batch_item_failures([item_identifier(record)])
+            elif item_identifier(record) in self.batch_item_failures:
+                failed_groups.add(key)
+
+    def batch_response(self):
+        return {
+            "batchItemFailures": [
+                {"itemIdentifier": identifier}
+                for identifier in self.batch_item_failures
+            ]
+        }
 
     def process_failed(self, name, record, reason, function_name=None):
+        # Let Lambda redeliver the failed items instead of storing a replay
+        if self.report_batch_item_failures:
+            failed = record.get("Records", [record])
+            identifiers = [item_identifier(r) for r in failed]
+            if all(identifiers):
+                self.add_batch_item_failures(identifiers)
+                with self._lock:
+                    self.failed_groups.update(
+                        key
+                        for key in map(ordering_key, failed)
+                        if key is not None
+                    )
+                logger.warning(
+                    "Reporting %d failed item(s) for %s (function: %s)",
+                    len(identifiers),
+                    name,
+                    function_name or "n/a",
+                )
+                return
+
         entry = {"bin": name, "reason": reason}
 
         # Store function name if provided (for DynamoDB granular replay)
         if function_name:
             entry["function_name"] = function_name
 
-        # If S3 bucket specified, store record there; else compress in DynamoDB
-        if self.s3_bucket:
+        if not self.deduplicate:
+            self.attach_payload(entry, gzip_json(record))
+            logger.warning(
+                "Queued replay for %s (function: %s)",
+                name,
+                function_name or "n/a",
+            )
+            self.add_replays(entry)
+            return
+
+        # Fold repeats of the same (bin, function_name, record) into one entry
+        fingerprint = replay_fingerprint(name, function_name, record)
+        entry["fingerprint"] = fingerprint
+        with self._lock:
+            existing = self.fingerprints.get(fingerprint)
+            if existing is not None:
+                existing["occurrences"] += 1
+                logger.info("Folded duplicate replay for %s into %s", name, fingerprint)
+                return
+            entry["occurrences"] = 1
+            self.fingerprints[fingerprint] = entry
+
+        payload = gzip_json(record)
+        duplicate = self.find_replay(fingerprint) if self.find_replay else None
+        if duplicate:
+            # the payload is only stored if the existing entry is gone by then
+            entry["duplicate_of"] = duplicate
+            entry["payload"] = payload
+            logger.warning("Replay for %s duplicates %s", name, duplicate)
+        else:
+            self.attach_payload(entry, payload)
+            logger.warning(
+                "Queued replay for %s (function: %s)",
+                name,
+                function_name or "n/a",
+            )
+        self.add_replays(entry)
+
+    def attach_payload(self, entry, payload):
+        """Keep small payloads inline in DynamoDB; large ones go to S3 if a
+        bucket is specified."""
+        inline_size = 4 * math.ceil(payload.getbuffer().nbytes / 3)
+        if self.s3_bucket and inline_size > INLINE_RECORD_LIMIT:
+            if self.pack_s3:
+                # uploaded with the rest of the invocation by flush_archive
+                with self._lock:
+                    self._archive.append((entry, payload))
+                return
             entry["s3_uri"] = store_record_s3(
-                record, self.s3_bucket, self.s3_key_prefix
+                None, self.s3_bucket, self.s3_key_prefix, payload=payload
             )
         else:
-            entry["record"] = compress_json(record)
+            if inline_size > INLINE_RECORD_LIMIT:
+                logger.warning(
+                    "Replay payload for %s is %d bytes and no s3_bucket is set",
+                    entry["bin"],
+                    inline_size,
+                )
+            entry["record"] = base64.b64encode(payload.getvalue()).decode()
 
-        logger.warning(
-            "Queued replay for %s (function: %s)",
-            name,
-            function_name or "n/a",
+    def flush_archive(self):
+        """Upload payloads held for packing as one S3 object and point their
+        entries at it."""
+        with self._lock:
+            pending, self._archive = self._archive, []
+        if not pending:
+            return
+        s3_uri, ranges = store_archive_s3(
+            [payload for _, payload in pending], self.s3_bucket, self.s3_key_prefix
         )
-        self.add_replays(entry)
+        for (entry, _), (offset, length) in zip(pending, ranges):
+            entry["s3_uri"] = s3_uri
+            entry["s3_offset"] = offset
+            entry["s3_length"] = length
+        logger.info("Packed %d replay payload(s) into %s", len(pending), s3_uri)
 
 
 def _process_batch(
@@ -209,26 +641,35 @@ def _process_batch(
     send_sentry,
     outpost,
     target_function_name=None,
+    bisect_depth=0,
+    bisect_time_budget=None,
+    dydb_wrapper=None,
 ):
-    """Process records as a batch"""
+    """Process records as a batch, returning the records that no batch
+    function handled and that still need individual processing."""
     batch_handler_cls = BatchHandlers(
-        file, records, context, target_function_name=target_function_name
+        file,
+        records,
+        context,
+        target_function_name=target_function_name,
+        dydb_wrapper=dydb_wrapper,
     )
 
     if not hasattr(batch_handler_cls, source_handler):
-        return False
+        return records
 
     try:
         method = getattr(batch_handler_cls, source_handler)
-        output = method()
+        with write_buffer_sources(records):
+            output = resolve_awaitable(method())
         if output is False:
-            return False
+            return records
         if output:
             outpost.add_processed(output)
             logger.info(
                 "Batch %s processed %d outputs", source_handler, len(outpost.processed)
             )
-        return True
+        return []
     except BaseException:
         if send_sentry:
             sentry_sdk.set_context("records", dumps(batch_handler_cls.records))
@@ -239,6 +680,24 @@ def _process_batch(
         if source_handler == "adhoc":
             raise
 
+        if bisect_depth and len(records) > 1:
+            deadline = time.monotonic() + (
+                float("inf") if bisect_time_budget is None else bisect_time_budget
+            )
+            return _bisect_batch(
+                file,
+                records,
+                context,
+                source_handler,
+                name,
+                outpost,
+                traceback.format_exc(),
+                bisect_depth,
+                deadline,
+                target_function_name=target_function_name,
+                dydb_wrapper=dydb_wrapper,
+            )
+
         # Store entire batch as single replay record
         batch_event = {"Records": records}
         outpost.process_failed(
@@ -248,7 +707,101 @@ def _process_batch(
             function_name=target_function_name,
         )
         logger.warning("Batch %s failed; stored for replay", source_handler)
-        return True
+        return []
+
+
+def _bisect_batch(
+    file,
+    records,
+    context,
+    source_handler,
+    name,
+    outpost,
+    reason,
+    depth,
+    deadline,
+    target_function_name=None,
+    dydb_wrapper=None,
+):
+    """Re-run a failed batch in halves until the failing records are isolated.
+    Halves that succeed are kept; the rest are stored for replay once a single
+    record, the depth limit or the time budget is reached. Halves without a
+    batch function for their first record are returned for individual
+    processing.
+    """
+    if len(records) == 1 or depth <= 0 or time.monotonic() >= deadline:
+        outpost.process_failed(
+            name,
+            {"Records": records},
+            reason,
+            function_name=target_function_name,
+        )
+        logger.warning(
+            "Batch %s isolated %d failing record(s)", source_handler, len(records)
+        )
+        return []
+
+    unhandled = []
+    middle = len(records) // 2
+    for half in (records[:middle], records[middle:]):
+        batch_handler_cls = BatchHandlers(
+            file,
+            half,
+            context,
+            target_function_name=target_function_name,
+            dydb_wrapper=dydb_wrapper,
+        )
+        try:
+            with write_buffer_sources(half):
+                output = resolve_awaitable(
+                    getattr(batch_handler_cls, source_handler)()
+                )
+            if output is False:
+                unhandled.extend(half)
+            elif output:
+                outpost.add_processed(output)
+        except BaseException:
+            unhandled += _bisect_batch(
+                file,
+                half,
+                context,
+                source_handler,
+                name,
+                outpost,
+                traceback.format_exc(),
+                depth - 1,
+                deadline,
+                target_function_name=target_function_name,
+                dydb_wrapper=dydb_wrapper,
+            )
+    return unhandled
+
+
+def _capture_failure(
+    record, source_handler, name, send_sentry, outpost, function_name=None
+):
+    """Report the exception being handled and queue record for replay."""
+    if send_sentry:
+        sentry_sdk.set_context("record", record)
+        if function_name:
+            sentry_sdk.set_context("function", function_name)
+        sentry_sdk.capture_exception()
+
+    if source_handler == "adhoc":
+        raise
+
+    outpost.process_failed(
+        name, record, traceback.format_exc(), function_name=function_name
+    )
+    logger.warning("%s record failed", source_handler)
+
+
+def _stream_functions(file, record, context, dydb_wrapper, before_request):
+    handler_cls = Handlers(file, record, context, dydb_wrapper, before_request)
+    wrapper = dydb_wrapper or StreamRecord
+    stream_record = wrapper(record)
+    m = handler_cls.module_handler(file, stream_record.trigger_module, folder="dynamodb")
+    return stream_record, getattr(m, stream_record.event_name, [])
 
 
 def _process_individual(
@@ -266,30 +819,35 @@ def _process_individual(
     """Process a single record"""
     # Special handling for DynamoDB to track individual function failures
     if source_handler == "dynamodb" and not target_function_name:
-        handler_cls = Handlers(file, record, context, dydb_wrapper, before_request)
-        wrapper = dydb_wrapper or StreamRecord
-        stream_record = wrapper(record)
-        m = handler_cls.module_handler(
-            file, stream_record.trigger_module, folder="dynamodb"
+        stream_record, functions = _stream_functions(
+            file, record, context, dydb_wrapper, before_request
         )
-        functions = getattr(m, stream_record.event_name, [])
 
-        for function in functions:
+        def run(function):
             try:
-                function(stream_record, context)
+                resolve_awaitable(function(stream_record, context))
             except BaseException:
-                if send_sentry:
-                    sentry_sdk.set_context("record", record)
-                    sentry_sdk.set_context("function", function.__name__)
-                    sentry_sdk.capture_exception()
-
                 # Store individual function failure
-                outpost.process_failed(
-                    name,
+                _capture_failure(
                     record,
-                    traceback.format_exc(),
+                    source_handler,
+                    name,
+                    send_sentry,
+                    outpost,
                     function_name=function.__name__,
                 )
+
+        if isinstance(functions, Independent) and len(functions) > 1:
+            executor = get_executor(INDEPENDENT_FUNCTION_WORKERS, "functions")
+            futures = [
+                executor.submit(contextvars.copy_context().run, run, function)
+                for function in functions
+            ]
+            for future in futures:
+                future.result()
+        else:
+            for function in functions:
+                run(function)
         return
 
     # Standard processing for other sources or targeted replay
@@ -300,23 +858,135 @@ def _process_individual(
             output = method(target_function_name=target_function_name)
         else:
             output = method()
+        output = resolve_awaitable(output)
         if output:
             outpost.add_processed(output)
             logger.debug("Processed individual %s event", source_handler)
     except BaseException:
-        if send_sentry:
-            sentry_sdk.set_context("record", record)
-            if target_function_name:
-                sentry_sdk.set_context("function", target_function_name)
-            sentry_sdk.capture_exception()
+        _capture_failure(
+            record,
+            source_handler,
+            name,
+            send_sentry,
+            outpost,
+            function_name=target_function_name,
+        )
 
-        if source_handler == "adhoc":
-            raise
 
-        outpost.process_failed(
-            name, record, traceback.format_exc(), function_name=target_function_name
+async def _process_individual_async(
+    file,
+    record,
+    context,
+    dydb_wrapper,
+    before_request,
+    source_handler,
+    name,
+    send_sentry,
+    outpost,
+    target_function_name=None,
+):
+    """Process a single record whose route exposes async handlers"""
+    if source_handler == "dynamodb" and not target_function_name:
+        stream_record, functions = _stream_functions(
+            file, record, context, dydb_wrapper, before_request
         )
-        logger.warning("%s record failed; queued for replay", source_handler)
+
+        independent = isinstance(functions, Independent) and len(functions) > 1
+        loop = asyncio.get_running_loop()
+        executor = get_executor(INDEPENDENT_FUNCTION_WORKERS, "functions")
+
+        async def run(function):
+            try:
+                if independent and not inspect.iscoroutinefunction(function):
+                    # sync members run on the functions pool, not the loop
+                    output = await loop.run_in_executor(
+                        executor,
+                        contextvars.copy_context().run,
+                        function,
+                        stream_record,
+                        context,
+                    )
+                else:
+                    output = function(stream_record, context)
+                if inspect.isawaitable(output):
+                    await output
+            except BaseException:
+                _capture_failure(
+                    record,
+                    source_handler,
+                    name,
+                    send_sentry,
+                    outpost,
+                    function_name=function.__name__,
+                )
+
+        if independent:
+            await asyncio.gather(*[run(function) for function in functions])
+        else:
+            for function in functions:
+                await run(function)
+        return
+
+    try:
+        handler_cls = Handlers(file, record, context, dydb_wrapper, before_request)
+        method = getattr(handler_cls, source_handler)
+        if source_handler == "dynamodb" and target_function_name:
+            output = method(target_function_name=target_function_name)
+        else:
+            output = method()
+        if inspect.isawaitable(output):
+            output = await output
+        if output:
+            outpost.add_processed(output)
+            logger.debug("Processed individual %s event", source_handler)
+    except BaseException:
+        _capture_failure(
+            record,
+            source_handler,
+            name,
+            send_sentry,
+            outpost,
+            function_name=target_function_name,
+        )
+
+
+def out_of_time(context, deadline_margin_ms):
+    return (
+        deadline_margin_ms is not None
+        and context is not None
+        and context.get_remaining_time_in_millis() < deadline_margin_ms
+    )
+
+
+def _defer_records(records, source_handler, name, outpost):
+    """Hand back records skipped before the Lambda timeout so they run again"""
+    deferred_ids = {id(record) for record in outpost.deferred}
+    deferred = [record for record in records if id(record) in deferred_ids]
+    logger.warning(
+        "Deferring %d unprocessed %s record(s) before timeout",
+        len(deferred),
+        source_handler,
+    )
+    if source_handler == "sqs" and not outpost.report_batch_item_failures:
+        queue_name = deferred[0]["eventSourceARN"].split(":")[-1]
+        Sqs(queue_name=queue_name).send_back_unprocessed(deferred)
+        return
+    for record in deferred:
+        outpost.process_failed(name, record, "Deferred before Lambda timeout")
+
+
+def _fail_buffered_writes(source_handler, name, outpost):
+    """Flush this invocation's write buffers and fail the records whose
+    buffered updates could not be written."""
+    failed = {}
+    for records, error in flush_write_buffers():
+        for record in records:
+            failed.setdefault(id(record), (record, error))
+    for record, error in failed.values():
+        if source_handler == "adhoc":
+            raise error
+        reason = traceback.format_exception(type(error), error, error.__traceback__)
+        outpost.process_failed(name, record, "".join(reason))
 
 
 def aws_lambda_handler(
@@ -327,9 +997,29 @@ def aws_lambda_handler(
     send_sentry=False,
     s3_bucket=None,
     s3_key_prefix="replay",
+    preload=False,
+    concurrency=None,
+    report_batch_item_failures=False,
+    bisect_depth=0,
+    bisect_time_budget=None,
+    deadline_margin_ms=None,
+    compact_stream=False,
+    deduplicate=False,
+    find_replay=None,
+    pack_s3=False,
 ):
-    def handler(event, context):
-        outpost = OutPost(s3_bucket=s3_bucket, s3_key_prefix=s3_key_prefix)
+    if preload:
+        preload_routes(file)
+
+    def handle(event, context):
+        outpost = OutPost(
+            s3_bucket=s3_bucket,
+            s3_key_prefix=s3_key_prefix,
+            report_batch_item_failures=report_batch_item_failures,
+            deduplicate=deduplicate,
+            find_replay=find_replay,
+            pack_s3=pack_s3,
+        )
 
         if "Records" not in event:
             outpost(many=False)
@@ -346,8 +1036,28 @@ def aws_lambda_handler(
             records[0].pop("_target_function_name", None) if records else None
         )
 
+        if compact_stream and source_handler == "dynamodb" and not target_function_name:
+            compacted = compact_stream_records(records)
+            logger.info(
+                "Compacted %d stream record(s) to %d", len(records), len(compacted)
+            )
+            records = compacted
+
+        # stream records are wrapped once and shared by every path below
+        stream_records = StreamRecords(dydb_wrapper)
+
+        # keep bisection within the invocation deadline
+        if deadline_margin_ms is not None and context is not None:
+            remaining = (
+                context.get_remaining_time_in_millis() - deadline_margin_ms
+            ) / 1000
+            if bisect_time_budget is not None:
+                remaining = min(remaining, bisect_time_budget)
+        else:
+            remaining = bisect_time_budget
+
         # batch processing
-        processed_in_batch = _process_batch(
+        unhandled = _process_batch(
             file,
             records,
             context,
@@ -356,29 +1066,81 @@ def aws_lambda_handler(
             send_sentry,
             outpost,
             target_function_name=target_function_name,
+            bisect_depth=bisect_depth,
+            bisect_time_budget=remaining,
+            dydb_wrapper=stream_records,
         )
 
-        # Skip individual processing when a batch handler successfully handled the set
-        if not processed_in_batch:
-            for record in records:
-                if target_function_name:
-                    logger.debug(
-                        "Targeted replay for function %s", target_function_name
-                    )
+        # Records the batch handlers did not take are processed individually
+        if unhandled:
+            if target_function_name:
+                logger.debug("Targeted replay for function %s", target_function_name)
 
-                _process_individual(
-                    file,
-                    record,
-                    context,
-                    dydb_wrapper,
-                    before_request,
-                    source_handler,
-                    name,
-                    send_sentry,
-                    outpost,
-                    target_function_name=target_function_name,
+            args = (
+                context,
+                stream_records,
+                before_request,
+                source_handler,
+                name,
+                send_sentry,
+                outpost,
+            )
+
+            if is_async_route(file, unhandled[0], source_handler, stream_records):
+
+                async def process_async(record):
+                    if outpost.hold_if_group_failed(record):
+                        return
+                    if out_of_time(context, deadline_margin_ms):
+                        outpost.add_deferred(record)
+                        return
+                    with write_buffer_sources([record]):
+                        await _process_individual_async(
+                            file,
+                            record,
+                            *args,
+                            target_function_name=target_function_name,
+                        )
+
+                run_async(
+                    _process_records_async(
+                        unhandled, process_async, concurrency=concurrency
+                    )
                 )
+            else:
+
+                def process(record):
+                    if outpost.hold_if_group_failed(record):
+                        return
+                    if out_of_time(context, deadline_margin_ms):
+                        outpost.add_deferred(record)
+                        return
+                    with write_buffer_sources([record]):
+                        _process_individual(
+                            file,
+                            record,
+                            *args,
+                            target_function_name=target_function_name,
+                        )
+
+                _process_records(unhandled, process, concurrency=concurrency)
 
+        try:
+            # buffered DbModel updates must land before the invocation ends,
+            # the records that queued a failed one fail with it
+            _fail_buffered_writes(source_handler, name, outpost)
+
+            if outpost.deferred:
+                _defer_records(records, source_handler, name, outpost)
+
+            if outpost.batch_item_failures:
+                outpost.hold_failed_groups(records)
+        finally:
+            outpost.flush_archive()
         return outpost
 
+    def handler(event, context):
+        with write_buffer_scope():
+            return handle(event, context)
+
     return handler
@@ -1,14 +1,25 @@
+import contextvars
+import heapq
+import random
+import time
+from collections import Counter
+from itertools import islice
+from operator import attrgetter
 from py_tools.handler import aws_lambda_handler as main_aws_lambda_handler
+from py_tools.handler import out_of_time, get_executor, ordering_key
 from py_tools.dydb import DbModel
 from py_tools.date import date_id
 from pynamodb.attributes import UnicodeAttribute, NumberAttribute
+from pynamodb.exceptions import UpdateError
+from pynamodb.indexes import AllProjection, GlobalSecondaryIndex, IncludeProjection
 from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
 import gzip
 import base64
 from py_tools.format import loads
 from py_tools.sentry import setup_sentry
-from py_tools.s3 import get_object
+from py_tools.s3 import get_object_bytes
 from py_tools.pylog import get_logger
+from py_tools.retry import backoff_delay
 
 
 logger = get_logger("py-tools.handler-replay")
@@ -23,13 +34,78 @@ def decompress_json(compressed_string):
     return data
 
 
-def fetch_record_from_s3(s3_uri):
-    """Parse s3_uri and fetch record from S3."""
+def fetch_record_from_s3(s3_uri, offset=None, length=None, archive=None):
+    """Parse s3_uri and fetch record from S3. Records in a packed archive are
+    read with a ranged GET, or sliced from the archive when already loaded.
+    """
     parts = s3_uri.replace("s3://", "").split("/", 1)
     bucket, key = parts[0], parts[1]
+    if offset is not None:
+        if archive is not None:
+            data = archive[offset : offset + length]
+        else:
+            logger.info("Fetching replay record from s3://%s/%s", bucket, key)
+            data = get_object_bytes(
+                bucket, key, Range=f"bytes={offset}-{offset + length - 1}"
+            )
+        return loads(gzip.decompress(data).decode())
+
     logger.info("Fetching replay record from s3://%s/%s", bucket, key)
-    data = get_object(bucket, key)
-    return loads(data)
+    data = get_object_bytes(bucket, key)
+    if key.endswith(".gz"):
+        data = gzip.decompress(data)
+    return loads(data.decode())
+
+
+def get_archive(s3_uri):
+    """Whole packed archive, fetched once for the items of a drain page."""
+    bucket, key = s3_uri.replace("s3://", "").split("/", 1)
+    logger.info("Fetching replay archive s3://%s/%s", bucket, key)
+    return get_object_bytes(bucket, key)
+
+
+def load_replay_record(item, archives=None):
+    """Fetch the record of a ReplayBin item from S3 or decompress it.
+    archives maps s3 uris to packed archives already fetched."""
+    if item.s3_uri:
+        archive = None
+        if item.s3_offset is not None and archives:
+            archive = archives.get(item.s3_uri)
+        return fetch_record_from_s3(
+            item.s3_uri, item.s3_offset, item.s3_length, archive=archive
+        )
+    return decompress_json(item.record)
+
+
+def replay_delay(attempt, base, cap, jitter=True):
+    """Seconds to wait before the next replay after attempt failed attempts.
+    Jitter keeps at least half the delay so a failed item is not due again
+    within the same drain."""
+    delay = backoff_delay(max(attempt - 1, 0), base, cap, jitter=False)
+    if jitter:
+        delay = delay / 2 + random.uniform(0, delay / 2)
+    return delay
+
+
+class NextAttemptIndex(GlobalSecondaryIndex):
+    """Sparse index of replay items by due time; dead items drop out of it."""
+
+    class Meta:
+        index_name = "next_attempt_index"
+        projection = AllProjection()
+
+    bin = UnicodeAttribute(hash_key=True)
+    next_attempt_at = NumberAttribute(range_key=True)
+
+
+class FingerprintIndex(GlobalSecondaryIndex):
+    """Replay items by content fingerprint, for folding duplicates."""
+
+    class Meta:
+        index_name = "fingerprint_index"
+        projection = IncludeProjection(["status"])
+
+    fingerprint = UnicodeAttribute(hash_key=True)
 
 
 class ReplayBin(DbModel):
@@ -43,8 +119,32 @@ class ReplayBin(DbModel):
     run_count = NumberAttribute(default=1)
     record = UnicodeAttribute(null=True)
     s3_uri = UnicodeAttribute(null=True)
+    s3_offset = NumberAttribute(null=True)  # set for packed archives
+    s3_length = NumberAttribute(null=True)
     reason = UnicodeAttribute()
     function_name = UnicodeAttribute(null=True)  # For DynamoDB granular replay
+    next_attempt_at = NumberAttribute(
+        null=True, default_for_new=lambda: int(time.time())
+    )
+    status = UnicodeAttribute(null=True)  # "dead" once max attempts are used up
+    fingerprint = UnicodeAttribute(null=True)
+    occurrences = NumberAttribute(default=1)
+    next_attempt_index = NextAttemptIndex()
+    fingerprint_index = FingerprintIndex()
+
+
+def find_replay(fingerprint):
+    """Return the (bin, replay_id) of a live bin item with this fingerprint."""
+    for item in ReplayBin.fingerprint_index.query(fingerprint):
+        if item.status != "dead":
+            return item.bin, item.replay_id
+
+
+def bin_keys(name, shards=1):
+    """Hash keys a bin is spread over; a single shard keeps the plain name."""
+    if shards <= 1:
+        return [name]
+    return [f"{name}#{shard}" for shard in range(shards)]
 
 
 def aws_lambda_handler(
@@ -57,6 +157,16 @@ def aws_lambda_handler(
     sentry_pii_denylist=None,
     s3_bucket=None,
     s3_key_prefix="replay",
+    preload=False,
+    concurrency=None,
+    report_batch_item_failures=False,
+    bisect_depth=0,
+    bisect_time_budget=None,
+    deadline_margin_ms=None,
+    compact_stream=False,
+    deduplicate=False,
+    pack_s3=False,
+    bin_shards=1,
 ):
     if sentry_dsn:
         setup_sentry(
@@ -68,18 +178,28 @@ def aws_lambda_handler(
             sentry_pii_denylist=sentry_pii_denylist,
         )
 
+    function = main_aws_lambda_handler(
+        file=file,
+        name=name,
+        dydb_wrapper=dydb_wrapper,
+        before_request=before_request,
+        send_sentry=(sentry_dsn is not None),
+        s3_bucket=s3_bucket,
+        s3_key_prefix=s3_key_prefix,
+        preload=preload,
+        concurrency=concurrency,
+        report_batch_item_failures=report_batch_item_failures,
+        bisect_depth=bisect_depth,
+        bisect_time_budget=bisect_time_budget,
+        deadline_margin_ms=deadline_margin_ms,
+        compact_stream=compact_stream,
+        deduplicate=deduplicate,
+        find_replay=find_replay if deduplicate else None,
+        pack_s3=pack_s3,
+    )
+
     def wrapper(event, context=None):
         logger.info("Handling replay save for %s", name)
-        function = main_aws_lambda_handler(
-            file=file,
-            name=name,
-            dydb_wrapper=dydb_wrapper,
-            before_request=before_request,
-            send_sentry=(sentry_dsn is not None),
-            s3_bucket=s3_bucket,
-            s3_key_prefix=s3_key_prefix,
-        )
-
         outpost = function(event, context)
         # add to replay table
         if outpost.replays:
@@ -87,9 +207,34 @@ def aws_lambda_handler(
                 "Captured %d replay item(s) for %s", len(outpost.replays), name
             )
             with ReplayBin.batch_write() as batch:
+                shards = bin_keys(name, bin_shards)
                 for item in outpost.replays:
+                    duplicate = item.pop("duplicate_of", None)
+                    payload = item.pop("payload", None)
+                    if duplicate:
+                        try:
+                            ReplayBin.update_item(
+                                hash_key=duplicate[0],
+                                range_key=duplicate[1],
+                                adds={"occurrences": item["occurrences"]},
+                            )
+                            continue
+                        except UpdateError:
+                            # replayed or removed meanwhile, store it after all
+                            outpost.attach_payload(item, payload)
+                            outpost.flush_archive()
+                    # spread writes over the bin shards
+                    item["bin"] = random.choice(shards)
                     batch.save(ReplayBin.save_attributes(item))
 
+        if report_batch_item_failures and outpost.many:
+            logger.info(
+                "Reporting %d batch item failure(s) for %s",
+                len(outpost.batch_item_failures),
+                name,
+            )
+            return outpost.batch_response()
+
         if not outpost.processed:
             logger.debug("No processed outputs for %s", name)
             return
@@ -110,6 +255,21 @@ def aws_lambda_replay_handler(
     sentry_pii_denylist=None,
     s3_bucket=None,
     s3_key_prefix="replay",
+    preload=False,
+    concurrency=None,
+    bisect_depth=0,
+    bisect_time_budget=None,
+    deadline_margin_ms=None,
+    compact_stream=False,
+    drain=False,
+    drain_concurrency=8,
+    drain_page_size=100,
+    drain_margin_ms=30000,
+    backoff_base=None,
+    backoff_cap=3600,
+    backoff_jitter=True,
+    max_attempts=None,
+    bin_shards=1,
 ):
     if sentry_dsn:
         setup_sentry(
@@ -123,53 +283,183 @@ def aws_lambda_replay_handler(
 
     file = file.replace("/adhoc/", "/")
 
+    function = main_aws_lambda_handler(
+        file=file,
+        name=name,
+        dydb_wrapper=dydb_wrapper,
+        before_request=before_request,
+        send_sentry=(sentry_dsn is not None),
+        s3_bucket=s3_bucket,
+        s3_key_prefix=s3_key_prefix,
+        preload=preload,
+        concurrency=concurrency,
+        bisect_depth=bisect_depth,
+        bisect_time_budget=bisect_time_budget,
+        deadline_margin_ms=deadline_margin_ms,
+        compact_stream=compact_stream,
+    )
+
+    def query_due(page_size=None):
+        """Due items of every bin shard, merged in replay order."""
+        if backoff_base is not None:
+            # only items whose next attempt is due, via the sparse index
+            now = int(time.time())
+            queries = [
+                ReplayBin.query(
+                    hash_key=bin_key,
+                    range_key_condition=ReplayBin.next_attempt_at <= now,
+                    index_name=NextAttemptIndex.Meta.index_name,
+                    page_size=page_size,
+                )
+                for bin_key in bin_keys(name, bin_shards)
+            ]
+            order = attrgetter("next_attempt_at")
+        else:
+            queries = []
+            for bin_key in bin_keys(name, bin_shards):
+                if max_attempts:
+                    ReplayBin.add_db_conditions(ReplayBin.status.does_not_exist())
+                queries.append(ReplayBin.query(hash_key=bin_key, page_size=page_size))
+            order = attrgetter("replay_id")
+        if len(queries) == 1:
+            return iter(queries[0])
+        return heapq.merge(*queries, key=order)
+
+    def reschedule(item):
+        """Count a failed replay and set when the item is due again, or mark
+        it dead after max_attempts. Returns the updates and deletes to apply.
+        """
+        item.run_count += 1
+        if max_attempts and item.run_count > max_attempts:
+            logger.warning(
+                "Replay item %s for %s is dead after %d attempt(s)",
+                item.replay_id,
+                name,
+                item.run_count - 1,
+            )
+            item.status = "dead"
+            item.next_attempt_at = None
+            return {"status": "dead"}, ["next_attempt_at"]
+        if backoff_base is not None:
+            delay = replay_delay(
+                item.run_count - 1, backoff_base, backoff_cap, backoff_jitter
+            )
+            item.next_attempt_at = int(time.time() + delay)
+            return {"next_attempt_at": item.next_attempt_at}, []
+        return {}, []
+
+    def replay(item, record, context):
+        """Replay one bin item, return True when it no longer fails."""
+        # For DynamoDB with function_name, do targeted replay
+        if item.function_name:
+            # Inject target function into event for targeted replay
+            target = record["Records"][0] if "Records" in record else record
+            target["_target_function_name"] = item.function_name
+            logger.info("Replaying %s targeting function %s", name, item.function_name)
+        outpost = function(record, context)
+        return not outpost.replays
+
+    def drain_bin(context):
+        """Replay the whole bin within the invocation time budget. Payloads of
+        a page are fetched concurrently and items replay in parallel, except
+        items sharing an ordering key (FIFO group / stream key), which replay
+        in order and stop at the first failure.
+        """
+        executor = get_executor(drain_concurrency, "replay")
+        blocked = set()
+        replayed, failed = 0, 0
+        due = query_due(page_size=drain_page_size)
+
+        while not out_of_time(context, drain_margin_ms):
+            items = list(islice(due, drain_page_size))
+            if not items:
+                break
+            # archives holding several items of the page are fetched once
+            archive_counts = Counter(
+                item.s3_uri for item in items if item.s3_offset is not None
+            )
+            shared = [uri for uri, count in archive_counts.items() if count > 1]
+            # kept for this page only, before the items fan out
+            archives = dict(zip(shared, executor.map(get_archive, shared)))
+            payloads = list(
+                executor.map(lambda item: load_replay_record(item, archives), items)
+            )
+            del archives
+
+            groups = {}
+            for index, (item, record) in enumerate(zip(items, payloads)):
+                key = ordering_key((record.get("Records") or [record])[0])
+                if key is None:
+                    key = ("unordered", index)
+                elif key in blocked:
+                    continue
+                groups.setdefault(key, []).append((item, record))
+
+            def replay_group(group):
+                done, failures = [], []
+                for item, record in group:
+                    if out_of_time(context, drain_margin_ms):
+                        break
+                    if replay(item, record, context):
+                        done.append(item)
+                    else:
+                        failures.append(item)
+                        break  # keep the rest of the group in order
+                return done, failures
+
+            futures = [
+                executor.submit(contextvars.copy_context().run, replay_group, group)
+                for group in groups.values()
+            ]
+            with ReplayBin.batch_write() as batch:
+                for key, future in zip(groups, futures):
+                    done, failures = future.result()
+                    for item in done:
+                        batch.delete(item)
+                    for item in failures:
+                        reschedule(item)
+                        batch.save(item)
+                        if key[0] != "unordered":
+                            blocked.add(key)
+                    replayed += len(done)
+                    failed += len(failures)
+
+        logger.info(
+            "Drained %d replay item(s) for %s, %d failed again", replayed, name, failed
+        )
+
     def wrapper(event=None, context=None):
         logger.info("Starting replay run for %s", name)
-        function = main_aws_lambda_handler(
-            file=file,
-            name=name,
-            dydb_wrapper=dydb_wrapper,
-            before_request=before_request,
-            send_sentry=(sentry_dsn is not None),
-            s3_bucket=s3_bucket,
-            s3_key_prefix=s3_key_prefix,
-        )
+        if drain:
+            return drain_bin(context)
 
-        for item in ReplayBin.query(hash_key=name, limit=10):
-            item = item.dict()
+        for item in islice(query_due(page_size=10), 10):
             logger.debug(
                 "Loaded replay item %s (run_count=%s)",
-                item["replay_id"],
-                item["run_count"],
+                item.replay_id,
+                item.run_count,
             )
 
             # Fetch record from S3 or decompress from DynamoDB
-            if item.get("s3_uri"):
-                record = fetch_record_from_s3(item["s3_uri"])
-            else:
-                record = decompress_json(item["record"])
-
-            # For DynamoDB with function_name, do targeted replay
-            target_function = item.get("function_name")
-            if target_function:
-                # Inject target function into event for targeted replay
-                record["_target_function_name"] = target_function
-                logger.info("Replaying %s targeting function %s", name, target_function)
-
-            outpost = function(record, context)
+            record = load_replay_record(item)
 
-            if outpost.replays:
+            if not replay(item, record, context):
+                updates, deletes = reschedule(item)
                 ReplayBin.update_item(
-                    hash_key=name, range_key=item["replay_id"], adds={"run_count": 1}
+                    hash_key=item.bin,
+                    range_key=item.replay_id,
+                    updates=updates,
+                    deletes=deletes,
+                    adds={"run_count": 1},
                 )
                 logger.warning(
                     "Replay for %s failed again; incremented run count", name
                 )
                 return  # return early for events to process in order
             else:
-                ReplayBin.delete_item(hash_key=name, range_key=item["replay_id"])
+                ReplayBin.delete_item(hash_key=item.bin, range_key=item.replay_id)
                 logger.info(
-                    "Replay for %s succeeded; removed bin %s", name, item["replay_id"]
+                    "Replay for %s succeeded; removed bin %s", name, item.replay_id
                 )
 
     return wrapper
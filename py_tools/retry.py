@@ -0,0 +1,19 @@
+import random
+import time
+
+BACKOFF_BASE = 0.05
+BACKOFF_CAP = 2
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP, jitter=True):
+    """Seconds to wait after attempt (from 0) failed attempts: capped
+    exponential backoff, with full jitter unless jitter is False."""
+    delay = min(cap, base * 2**attempt)
+    if jitter:
+        return random.uniform(0, delay)
+    return delay
+
+
+def backoff_sleep(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Sleep for backoff_delay(attempt), shared by the DynamoDB retry loops."""
+    time.sleep(backoff_delay(attempt, base, cap))
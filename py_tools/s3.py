@@ -10,10 +10,13 @@ from py_tools.format import loads
 s3 = boto3.client("s3")
 
 
-def get_object(bucket, key, **kwargs):
+def get_object_bytes(bucket, key, **kwargs):
     response = s3.get_object(Bucket=bucket, Key=key, **kwargs)
-    response = response["Body"].read().decode("utf-8")
-    return response
+    return response["Body"].read()
+
+
+def get_object(bucket, key, **kwargs):
+    return get_object_bytes(bucket, key, **kwargs).decode("utf-8")
 
 
 def get_object_head(bucket, key):
@@ -89,3 +92,8 @@ def upload_file(file_name, bucket, object_name=None):
     if object_name is None:
         object_name = os.path.basename(file_name)
     s3.upload_file(file_name, bucket, object_name)
+
+
+def upload_fileobj(fileobj, bucket, object_name, **extra_args):
+    # managed transfer, switches to multipart upload for large objects
+    s3.upload_fileobj(fileobj, bucket, object_name, ExtraArgs=extra_args or None)